@@ -0,0 +1,214 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import select
+
+from matching import EMBEDDING_DIM, MATCH_BATCH_SIZE, MATCH_DISTANCE_THRESHOLD, find_nearest_products
+from models import ProductEmbeddings
+
+# Optional HNSW backend
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger("ann_index")
+
+# "flat" (exact, NumPy) or "hnsw" (hnswlib) keeps product embeddings in memory; empty matches in Postgres only
+ANN_INDEX = os.getenv("ANN_INDEX", "")
+# Lookups per batch re-run against pgvector to check the in-memory index agrees (0 disables)
+ANN_CONSISTENCY_SAMPLE = int(os.getenv("ANN_CONSISTENCY_SAMPLE", "10"))
+
+
+class NearestMatch(NamedTuple):
+    """
+    Same attributes as the rows returned by find_nearest_products.
+    """
+    product_id: int
+    distance: float
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class FlatIndex:
+    """
+    Exact cosine search: one contiguous float32 matrix of normalized embeddings,
+    grown by doubling, searched with a single matrix product.
+    """
+    name = "flat"
+
+    def __init__(self, capacity: int = 1024):
+        self.matrix = np.empty((capacity, EMBEDDING_DIM), dtype=np.float32)
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def add(self, product_ids, vectors: np.ndarray):
+        needed = self.size + len(vectors)
+        if needed > len(self.matrix):
+            capacity = max(needed, 2 * len(self.matrix))
+            self.matrix = np.resize(self.matrix, (capacity, EMBEDDING_DIM))
+            self.ids = np.resize(self.ids, capacity)
+        self.matrix[self.size:needed] = vectors
+        self.ids[self.size:needed] = product_ids
+        self.size = needed
+
+    def search(self, vectors: np.ndarray):
+        """
+        Returns (product_ids, distances) of the nearest embedding of every vector.
+        """
+        similarity = vectors @ self.matrix[:self.size].T
+        best = similarity.argmax(axis=1)
+        return self.ids[best], 1 - similarity[np.arange(len(vectors)), best]
+
+    def __len__(self):
+        return self.size
+
+
+class HNSWIndex:
+    """
+    hnswlib graph with cosine space (distance = 1 - cosine, same as pgvector's <=>).
+    """
+    name = "hnsw"
+
+    def __init__(self, capacity: int = 1024, ef_construction: int = 200, m: int = 16, ef: int = 64):
+        if hnswlib is None:
+            raise ImportError("The 'hnsw' index requires the hnswlib package")
+        self.index = hnswlib.Index(space="cosine", dim=EMBEDDING_DIM)
+        self.index.init_index(max_elements=capacity, ef_construction=ef_construction, M=m)
+        self.index.set_ef(ef)
+
+    def add(self, product_ids, vectors: np.ndarray):
+        needed = self.index.get_current_count() + len(vectors)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, np.asarray(product_ids, dtype=np.int64))
+
+    def search(self, vectors: np.ndarray):
+        labels, distances = self.index.knn_query(vectors, k=1)
+        return labels[:, 0], distances[:, 0]
+
+    def __len__(self):
+        return self.index.get_current_count()
+
+
+INDEX_BACKENDS = {
+    "flat": FlatIndex,
+    "hnsw": HNSWIndex,
+}
+
+
+class ProductIndex:
+    """
+    In-process nearest product index kept in sync with product_embeddings.
+    Loaded once at startup and extended with add() as products are inserted.
+    Lookups whose nearest product is not within the match threshold fall back
+    to pgvector, so products inserted by other workers are still found.
+    """
+
+    def __init__(self, backend: str = "flat"):
+        if backend not in INDEX_BACKENDS:
+            raise ValueError(f"Unknown ANN index '{backend}', expected one of {list(INDEX_BACKENDS)}")
+        self.index = INDEX_BACKENDS[backend]()
+        # Guards the index and the stats, match() runs in several DB worker threads
+        self.lock = threading.Lock()
+        self.stats = {"lookups": 0, "index_hits": 0, "fallbacks": 0, "checked": 0, "disagreements": 0}
+
+    def load(self, session, chunk_size: int = 10000):
+        """
+        Streams every stored embedding into the index.
+        """
+        started = time.perf_counter()
+        rows = session.execute(
+            select(ProductEmbeddings.product_id, ProductEmbeddings.embedding)
+            .where(ProductEmbeddings.product_id.is_not(None))
+            .execution_options(yield_per=chunk_size)
+        )
+        for chunk in rows.partitions():
+            self.add([row.product_id for row in chunk], [row.embedding for row in chunk])
+        logger.info(f"✅ Loaded {len(self.index)} embeddings into the {self.index.name} index in {time.perf_counter() - started:.1f}s")
+        return self
+
+    def add(self, product_ids, vectors):
+        if len(product_ids) == 0:
+            return
+        vectors = normalize_rows(vectors)
+        with self.lock:
+            self.index.add(product_ids, vectors)
+
+    def search(self, vectors) -> list:
+        """
+        Nearest product of every vector according to the index alone
+        (None when the index is empty).
+        """
+        vectors = normalize_rows(vectors)
+        with self.lock:
+            if len(self.index) == 0 or len(vectors) == 0:
+                return [None] * len(vectors)
+            product_ids, distances = self.index.search(vectors)
+        return [NearestMatch(int(p), float(d)) for p, d in zip(product_ids, distances)]
+
+    def match(self, session, vectors, threshold: float = MATCH_DISTANCE_THRESHOLD,
+              batch_size: int = MATCH_BATCH_SIZE, sample: int = ANN_CONSISTENCY_SAMPLE) -> list:
+        """
+        Drop-in replacement for find_nearest_products: matches within `threshold`
+        come from the index, the rest are resolved by pgvector.
+        """
+        results = self.search(vectors)
+        misses = [i for i, r in enumerate(results) if r is None or r.distance >= threshold]
+        if misses:
+            for i, row in zip(misses, find_nearest_products(session, [vectors[i] for i in misses], batch_size)):
+                if row is not None and (results[i] is None or row.distance < results[i].distance):
+                    results[i] = row
+        with self.lock:
+            self.stats["lookups"] += len(results)
+            self.stats["index_hits"] += len(results) - len(misses)
+            self.stats["fallbacks"] += len(misses)
+        missed = set(misses)
+        hits = [i for i in range(len(results)) if i not in missed]
+        if sample and hits:
+            self.check_consistency(session, vectors, results, random.sample(hits, min(sample, len(hits))))
+        return results
+
+    def check_consistency(self, session, vectors, results: list, positions: list):
+        """
+        Re-runs some index matches through pgvector and logs disagreements.
+        """
+        expected = find_nearest_products(session, [vectors[i] for i in positions])
+        disagreements = 0
+        for i, row in zip(positions, expected):
+            if row is None or (row.product_id != results[i].product_id and abs(row.distance - results[i].distance) > 1e-4):
+                disagreements += 1
+                logger.warning(f"⚠️ ANN index returned {results[i]} but pgvector returned {row}")
+        with self.lock:
+            self.stats["checked"] += len(positions)
+            self.stats["disagreements"] += disagreements
+
+    def index_stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            size = len(self.index)
+        lookups = stats["lookups"]
+        return {
+            **stats,
+            "backend": self.index.name,
+            "size": size,
+            "hit_ratio": round(stats["index_hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+def load_product_index(session, backend: str = ANN_INDEX):
+    """
+    Builds the index configured by ANN_INDEX, or returns None when it is disabled.
+    """
+    if not backend:
+        return None
+    return ProductIndex(backend).load(session)
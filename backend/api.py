@@ -1,12 +1,22 @@
 import asyncio
+import base64
+import datetime
+import json
+import threading
+import time
+from contextlib import aclosing, contextmanager
 from models import *
 
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sentence_transformers import SentenceTransformer
-from base.mercadolibre import MercadoLibre
-from sqlalchemy import select
+from base.mercadolibre import PAGE_FINGERPRINTS, MercadoLibre
+from base.page_cache import PageCache
+from matching import MATCH_DISTANCE_THRESHOLD, MATCH_EF_SEARCH, find_nearest_clustered, nearest_products
+from embedding_cache import EmbeddingCache
+from ann_index import load_product_index
+from ingest import ingest, mark_queries_scraped, safe_commit
+from sqlalchemy import func, select
 from sqlalchemy.exc import PendingRollbackError
 import os
 
@@ -20,12 +30,256 @@ import traceback
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("api")
 
+# Listings per matching/ingest batch and pages fetched concurrently during a scrape
+SCRAPE_BATCH_SIZE = int(os.getenv("SCRAPE_BATCH_SIZE", "500"))
+MAX_PAGES_IN_FLIGHT = int(os.getenv("MAX_PAGES_IN_FLIGHT", "20"))
+# Worker processes parsing HTML off the event loop during a scrape (0 parses inline)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))
+# Page fingerprint cache kept across scrapes: unchanged pages skip parsing and DB work (0 disables)
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "0"))
+PAGE_CACHE_MAX_AGE = float(os.getenv("PAGE_CACHE_MAX_AGE", "0")) or None
+# Read the result count from page 1 and only fetch the pages that exist
+ADAPTIVE_PAGINATION = os.getenv("ADAPTIVE_PAGINATION", "true").lower() == "true"
+
+# Load the embedding model and the ANN index in a background thread at startup
+# (otherwise they load on first use); /ready reports when they are done
+API_WARMUP = os.getenv("API_WARMUP", "true").lower() == "true"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+# Connection pool shared by the request sessions: pool_size kept open, max_overflow
+# extra under load, recycled after DB_POOL_RECYCLE seconds, DB_POOL_TIMEOUT to wait for one
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Products per /query/results page and the listings/prices nested under each one
+RESULTS_PAGE_SIZE = int(os.getenv("RESULTS_PAGE_SIZE", "50"))
+RESULTS_LISTINGS_PER_PRODUCT = int(os.getenv("RESULTS_LISTINGS_PER_PRODUCT", "50"))
+RESULTS_PRICES_PER_LISTING = int(os.getenv("RESULTS_PRICES_PER_LISTING", "30"))
+# Rows fetched per round trip from the server-side cursor of streaming endpoints
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+# Points of the downsampled price series per listing in the summary view
+RESULTS_SERIES_BUCKETS = int(os.getenv("RESULTS_SERIES_BUCKETS", "30"))
+RESULT_LISTING_FIELDS = ["id", "external_id", "title", "url", "img_url", "created_at", "last_seen", "prices"]
+# The summary view replaces the raw prices with aggregates read from price_rollups
+SUMMARY_LISTING_FIELDS = RESULT_LISTING_FIELDS[:-1] + ["summary", "series"]
+ROLLUP_BUCKETS = ["hour", "day", "week"]
+
+# Keyset pages over the products of a query. Every step is bounded: one page of
+# product ids, a LIMIT per product for listings and a LIMIT per listing for prices.
+QUERY_RESULTS_PRODUCTS = text("""
+    SELECT pro.id, pro.name
+    FROM products pro
+    WHERE pro.id IN (
+        SELECT DISTINCT pc.product_id
+        FROM product_candidates pc
+        WHERE pc.query_id = :query_id
+          AND pc.product_id > :after
+          AND (CAST(:since AS timestamp) IS NULL OR EXISTS (
+              SELECT 1 FROM prices p
+              WHERE p.listing_id = pc.listing_id AND p.scraped_at >= :since
+          ))
+        ORDER BY pc.product_id
+        LIMIT :limit
+    )
+    ORDER BY pro.id
+""")
+
+QUERY_RESULTS_LISTINGS = text("""
+    SELECT page.product_id, l.id, l.external_id, l.title, l.url, l.img_url, l.created_at, l.last_seen
+    FROM unnest(CAST(:product_ids AS int[])) AS page(product_id)
+    CROSS JOIN LATERAL (
+        SELECT DISTINCT ON (l.id) l.*
+        FROM product_candidates pc
+        INNER JOIN listings l ON pc.listing_id = l.id
+        WHERE pc.query_id = :query_id
+          AND pc.product_id = page.product_id
+          AND (CAST(:since AS timestamp) IS NULL OR EXISTS (
+              SELECT 1 FROM prices p
+              WHERE p.listing_id = l.id AND p.scraped_at >= :since
+          ))
+        ORDER BY l.id
+        LIMIT :listings_per_product
+    ) l
+    ORDER BY page.product_id, l.id
+""")
+
+QUERY_RESULTS_PRICES = text("""
+    SELECT page.listing_id, p.price, p.scraped_at
+    FROM unnest(CAST(:listing_ids AS text[])) AS page(listing_id)
+    CROSS JOIN LATERAL (
+        SELECT p.price, p.scraped_at, p.id
+        FROM prices p
+        WHERE p.listing_id = page.listing_id
+          AND (CAST(:since AS timestamp) IS NULL OR p.scraped_at >= :since)
+        ORDER BY p.scraped_at DESC, p.id DESC
+        LIMIT :prices_per_listing
+    ) p
+    ORDER BY page.listing_id, p.scraped_at, p.id
+""")
+
+# Latest price overall plus min/max/avg over the buckets since the window start
+QUERY_RESULTS_SUMMARY = text("""
+    SELECT
+        page.listing_id,
+        latest.last_price AS latest_price,
+        latest.last_scraped_at AS latest_at,
+        stats.min_price,
+        stats.max_price,
+        stats.avg_price,
+        stats.price_count
+    FROM unnest(CAST(:listing_ids AS text[])) AS page(listing_id)
+    LEFT JOIN LATERAL (
+        SELECT r.last_price, r.last_scraped_at
+        FROM price_rollups r
+        WHERE r.listing_id = page.listing_id AND r.bucket_width = 'week'
+        ORDER BY r.bucket_start DESC
+        LIMIT 1
+    ) latest ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT
+            min(r.min_price) AS min_price,
+            max(r.max_price) AS max_price,
+            sum(r.sum_price) / NULLIF(sum(r.price_count), 0) AS avg_price,
+            COALESCE(sum(r.price_count), 0) AS price_count
+        FROM price_rollups r
+        WHERE r.listing_id = page.listing_id
+          AND r.bucket_width = :bucket
+          AND (CAST(:since AS timestamp) IS NULL OR r.bucket_start >= date_trunc(:bucket, CAST(:since AS timestamp)))
+    ) stats ON TRUE
+""")
+
+# Latest `buckets` rollup rows per listing, returned oldest first
+QUERY_RESULTS_SERIES = text("""
+    SELECT page.listing_id, s.bucket_start, s.min_price, s.max_price, s.avg_price, s.last_price
+    FROM unnest(CAST(:listing_ids AS text[])) AS page(listing_id)
+    CROSS JOIN LATERAL (
+        SELECT
+            r.bucket_start,
+            r.min_price,
+            r.max_price,
+            r.sum_price / NULLIF(r.price_count, 0) AS avg_price,
+            r.last_price
+        FROM price_rollups r
+        WHERE r.listing_id = page.listing_id
+          AND r.bucket_width = :bucket
+          AND (CAST(:since AS timestamp) IS NULL OR r.bucket_start >= date_trunc(:bucket, CAST(:since AS timestamp)))
+        ORDER BY r.bucket_start DESC
+        LIMIT :buckets
+    ) s
+    ORDER BY page.listing_id, s.bucket_start
+""")
+
+# Every listing/price row of a query for the streaming endpoint, grouped by the
+# caller while it is read from a server-side cursor (hence the ORDER BY)
+STREAM_QUERY_RESULTS = text("""
+    SELECT
+        pro.id AS product_id,
+        pro.name,
+        l.id,
+        l.external_id,
+        l.title,
+        l.url,
+        l.img_url,
+        l.created_at,
+        l.last_seen,
+        p.price,
+        p.scraped_at
+    FROM (
+        SELECT DISTINCT product_id, listing_id
+        FROM product_candidates
+        WHERE query_id = :query_id
+    ) pc
+    INNER JOIN products pro ON pc.product_id = pro.id
+    INNER JOIN listings l ON pc.listing_id = l.id
+    LEFT JOIN prices p ON p.listing_id = l.id
+    WHERE CAST(:since AS timestamp) IS NULL OR p.scraped_at >= :since
+    ORDER BY pro.id, l.id, p.scraped_at, p.id
+""")
+
+# Schema changes of the migrations that create_all does not apply to an existing
+# database (bootstrap): all idempotent, so they run on every initialize_database
+ADD_QUERY_LAST_SCRAPED_AT = text("ALTER TABLE queries ADD COLUMN IF NOT EXISTS last_scraped_at TIMESTAMP")
+# 20250624120000_price_rollups.sql backfill, only run while price_rollups is empty
+BACKFILL_PRICE_ROLLUPS = text("""
+    INSERT INTO price_rollups (
+        listing_id, bucket_width, bucket_start, min_price, max_price,
+        sum_price, price_count, last_price, last_scraped_at
+    )
+    SELECT
+        p.listing_id,
+        w.width,
+        date_trunc(w.width, p.scraped_at),
+        min(p.price),
+        max(p.price),
+        sum(p.price),
+        count(p.price),
+        (array_agg(p.price ORDER BY p.scraped_at DESC, p.id DESC))[1],
+        max(p.scraped_at)
+    FROM prices p
+    CROSS JOIN (VALUES ('hour'), ('day'), ('week')) AS w(width)
+    WHERE p.listing_id IS NOT NULL AND p.scraped_at IS NOT NULL
+    GROUP BY p.listing_id, w.width, date_trunc(w.width, p.scraped_at)
+    ON CONFLICT DO NOTHING
+""")
+# Indexes of 20250622120000_quantized_embedding_indexes.sql and
+# 20250623120000_query_results_indexes.sql, built CONCURRENTLY (outside a transaction)
+CONCURRENT_INDEXES = {
+    "product_embeddings_halfvec_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS product_embeddings_halfvec_idx
+        ON product_embeddings
+        USING hnsw ((embedding::halfvec(384)) halfvec_cosine_ops)
+        WITH (m = 16, ef_construction = 64)
+    """,
+    "product_embeddings_binary_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS product_embeddings_binary_idx
+        ON product_embeddings
+        USING hnsw ((binary_quantize(embedding)::bit(384)) bit_hamming_ops)
+        WITH (m = 16, ef_construction = 64)
+    """,
+    "product_candidates_query_product_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS product_candidates_query_product_idx
+        ON product_candidates (query_id, product_id, listing_id)
+    """,
+    "prices_listing_scraped_at_idx": """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS prices_listing_scraped_at_idx
+        ON prices (listing_id, scraped_at DESC, id DESC)
+    """,
+}
+
+
+
+def encode_results_cursor(product_id:int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"after": product_id}).encode()).decode()
+
+
+def decode_results_cursor(cursor:str) -> int:
+    """
+    Opaque cursor -> last product id of the previous page (0 for the first page).
+    """
+    if not cursor:
+        return 0
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["after"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
 def serialize_model(model):
     """
     Serialize a SQLAlchemy model instance into a dictionary.
     """
     columns = [column.key for column in class_mapper(model.__class__).columns]
     return {column: getattr(model, column) for column in columns}
+def create_pooled_engine(database_url:str):
+    return create_engine(
+        database_url,
+        pool_pre_ping=True,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
 # Create a database engine
 class API():
     def __init__(self):
@@ -34,32 +288,73 @@ class API():
             DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+psycopg2://")
         logger.info(f"Using DATABASE_URL: {DATABASE_URL}")
         
+        # Nothing here touches the database or loads the model, so the process
+        # serves /health right away. The schema is created by `python bootstrap.py`.
+        self.engine = create_pooled_engine(DATABASE_URL)
+        # Request handlers open their own session with session_scope(); self.session
+        # is only used for the background scrape
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.session = self.Session()
+
+        self.model = None
+        self.model_lock = threading.Lock()
+        # Title vectors shared by matching and new ProductEmbeddings rows, the model
+        # is loaded by the first title that is not cached
+        self.embedding_cache = EmbeddingCache(None, loader=self.load_model)
+        # Optional in-memory nearest product index (ANN_INDEX), pgvector stays the source of truth
+        self.product_index = None
+        self.ready = threading.Event()
+        self.warmup_error = None
+
+        self.page_cache = PageCache(
+            max_entries=PAGE_CACHE_MAX_ENTRIES,
+            max_age=PAGE_CACHE_MAX_AGE
+        ) if PAGE_CACHE_MAX_ENTRIES > 0 else None
+
+    def load_model(self):
+        """
+        Loads the SentenceTransformer once, whichever of the warm-up thread or
+        the first encode gets here first.
+        """
+        with self.model_lock:
+            if self.model is None:
+                started = time.perf_counter()
+                # Imported here: importing sentence_transformers (torch) alone takes seconds
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(EMBEDDING_MODEL)
+                logger.info(f"✅ SentenceTransformer model loaded in {time.perf_counter() - started:.1f}s")
+        return self.model
+
+    def warm_up(self):
+        """
+        Loads the model and the ANN index; sets `ready` when done, even if one failed.
+        """
         try:
-            self.engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-            self.session = sessionmaker(bind=self.engine)()
-            
-            # Test the connection
-            self.session.execute(text("SELECT 1"))
-            logger.info("✅ Database connection successful")
-            
-            # Initialize database tables
-            self.initialize_database()
-            
-        except Exception as e:
-            logger.error(f"❌ Database connection failed: {e}")
-            # Initialize session anyway for health checks
-            self.engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-            self.session = sessionmaker(bind=self.engine)()
-        
-        try:
-            # Log memory usage before loading model
-            self.model = SentenceTransformer('all-MiniLM-L6-v2')
-            logger.info(f"✅ SentenceTransformer model loaded successfully")
+            self.load_model()
         except Exception as e:
             logger.error(f"❌ Failed to load SentenceTransformer model: {e}")
-            logger.error(f"❌ Error type: {type(e).__name__}")
             logger.error(f"❌ Full traceback: {traceback.format_exc()}")
-            self.model = None
+            self.warmup_error = f"model: {e}"
+        try:
+            with self.session_scope() as session:
+                self.product_index = load_product_index(session)
+        except Exception as e:
+            logger.error(f"❌ Failed to load ANN index: {e}")
+            self.warmup_error = f"ann index: {e}"
+        self.ready.set()
+
+    def start_warm_up(self) -> threading.Thread:
+        thread = threading.Thread(target=self.warm_up, name="api-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def readiness(self) -> dict:
+        return {
+            "ready": self.ready.is_set() and self.warmup_error is None,
+            "model_loaded": self.model is not None,
+            "product_index": self.product_index.index_stats() if self.product_index is not None else None,
+            "error": self.warmup_error,
+        }
 
     def initialize_database(self):
         """
@@ -76,6 +371,9 @@ class API():
             Base.metadata.create_all(self.engine)
             logger.info("✅ Database tables created successfully")
             
+            # Columns, backfills and indexes create_all does not add to existing tables
+            self.apply_schema_updates()
+
             # Check if basic data exists, if not create it
             self.create_basic_data()
             
@@ -84,6 +382,33 @@ class API():
             logger.error(f"❌ Full traceback: {traceback.format_exc()}")
             raise e
 
+    def apply_schema_updates(self):
+        """
+        Applies the later migrations to an existing database: the
+        queries.last_scraped_at column, the price_rollups backfill and the
+        indexes built concurrently. Every step is idempotent.
+        """
+        try:
+            self.session.execute(ADD_QUERY_LAST_SCRAPED_AT)
+            if not self.session.execute(text("SELECT EXISTS (SELECT 1 FROM price_rollups)")).scalar():
+                result = self.session.execute(BACKFILL_PRICE_ROLLUPS)
+                logger.info(f"✅ Backfilled {result.rowcount} price rollups")
+            self.session.commit()
+        except Exception as e:
+            logger.error(f"❌ Failed to apply schema updates: {e}")
+            self.session.rollback()
+            raise e
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            for name, statement in CONCURRENT_INDEXES.items():
+                try:
+                    connection.execute(text(statement))
+                    logger.info(f"✅ Index {name} ready")
+                except Exception as e:
+                    # e.g. the quantized indexes need pgvector >= 0.7, only used with MATCH_PRECISION=halfvec|binary
+                    logger.warning(f"⚠️ Could not create index {name}: {e}")
+
     def create_enum_types(self):
         """
         Create required enum types for the database
@@ -159,6 +484,31 @@ class API():
             self.session.rollback()
             raise e
 
+    @contextmanager
+    def session_scope(self):
+        """
+        Session for one request, checked out of the pool and returned to it on exit.
+        Commits when the block succeeds and rolls back when it raises.
+        """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def pool_status(self) -> dict:
+        pool = self.engine.pool
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "checked_in": pool.checkedin(),
+        }
+
     def safe_commit(self):
         """
         Safely commit the session, handling PendingRollbackError.
@@ -168,154 +518,225 @@ class API():
         except PendingRollbackError:
             self.session.rollback()
             raise Exception("Transaction failed and was rolled back.")
-    def get_query_results(self, query_id:int):
-        query = text(f"""
-        SELECT l.id,l.external_id,l.title,l.url,p.price,p.scraped_at,pro.name,pro.created_at,l.img_url,
-                     l.created_at,l.last_seen
-        FROM product_candidates pc
-        INNER JOIN products pro ON pc.product_id = pro.id
-        INNER JOIN listings l ON pc.listing_id = l.id
-        INNER JOIN prices p ON l.id = p.listing_id
-        WHERE pc.query_id = {query_id}
-        """)
-        try:
-            result = self.session.execute(query).fetchall()
-            # Convert the result to a list of dictionaries
-            products = dict()
+    def get_query_results(self, query_id:int, limit:int = RESULTS_PAGE_SIZE, cursor:str = None, since:datetime.datetime = None,
+                          fields:list = None, listings_per_product:int = RESULTS_LISTINGS_PER_PRODUCT,
+                          prices_per_listing:int = RESULTS_PRICES_PER_LISTING, view:str = "prices",
+                          bucket:str = "day", buckets:int = RESULTS_SERIES_BUCKETS):
+        """
+        One page of the products matched by a query, ordered by product id.
+        Each product carries up to `listings_per_product` listings (by id) and each
+        listing its latest `prices_per_listing` prices, oldest first. `since` keeps
+        only prices scraped from then on (and the listings/products that have one).
+        `fields` projects the listing keys. Returns (products, next_cursor).
 
-            for row in result:
-                product_id = row[6]
-                if product_id in products:
-                    listings = products[product_id]["listings"]
-                else:
-                    products[product_id] = {
-                        "id": product_id,
-                        "name": row[7],
-                        "listings": dict()
-                    }
-                    listings = products[product_id]["listings"]
-                
-                if row[0] in listings:
-                    listings[row[0]]["prices"].append({"price": row[4], "created_at": row[5]})
-                else:
-                    listing = {
-                        "id": row[0],
-                        "external_id": row[1],
-                        "title": row[2],
-                        "url": row[3],
-                        "img_url": row[8],	
-                        "created_at": row[9],
-                        "last_seen": row[10],
-                        "prices":[
-                            {"price": row[4], "created_at": row[5]}
-                        ]
+        view="summary" reads price_rollups instead of prices: a `summary` (latest
+        price, min/max/avg since `since`) and a `series` of the last `buckets`
+        hour/day/week buckets per listing.
+        """
+        if view not in ("prices", "summary"):
+            raise ValueError(f"Unknown view '{view}', expected 'prices' or 'summary'")
+        if bucket not in ROLLUP_BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', expected one of {ROLLUP_BUCKETS}")
+        after = decode_results_cursor(cursor)
+        view_fields = RESULT_LISTING_FIELDS if view == "prices" else SUMMARY_LISTING_FIELDS
+        listing_fields = view_fields if not fields else [f for f in view_fields if f in fields]
+        price_fields = [f for f in listing_fields if f in ("prices", "summary", "series")]
+        params = {
+            "query_id": query_id,
+            "after": after,
+            "limit": limit + 1,
+            "since": since,
+            "listings_per_product": listings_per_product,
+            "prices_per_listing": prices_per_listing,
+            "bucket": bucket,
+            "buckets": buckets,
+        }
+        with self.session_scope() as session:
+            rows = session.execute(QUERY_RESULTS_PRODUCTS, params).fetchall()
+            next_cursor = encode_results_cursor(rows[limit - 1].id) if len(rows) > limit else None
+            rows = rows[:limit]
+            products = {
+                row.id: {"id": row.id, "name": row.name, "listings": []}
+                for row in rows
+            }
+            if not products:
+                return [], None
+
+            listings = {}
+            for row in session.execute(QUERY_RESULTS_LISTINGS, {**params, "product_ids": list(products)}):
+                listing = {field: getattr(row, field) for field in listing_fields if field not in price_fields}
+                if price_fields:
+                    listing.update({field: None if field == "summary" else [] for field in price_fields})
+                    # A listing can be a candidate of more than one product in the page
+                    listings.setdefault(row.id, []).append(listing)
+                products[row.product_id]["listings"].append(listing)
+
+            if listings:
+                params["listing_ids"] = list(listings)
+            if listings and "prices" in price_fields:
+                for row in session.execute(QUERY_RESULTS_PRICES, params):
+                    for listing in listings[row.listing_id]:
+                        listing["prices"].append({"price": row.price, "created_at": row.scraped_at})
+            if listings and "summary" in price_fields:
+                for row in session.execute(QUERY_RESULTS_SUMMARY, params):
+                    summary = {
+                        "latest_price": row.latest_price,
+                        "latest_at": row.latest_at,
+                        "min_price": row.min_price,
+                        "max_price": row.max_price,
+                        "avg_price": row.avg_price,
+                        "price_count": row.price_count,
                     }
-                    listings[row[0]] = listing
-            for key in products:
-                products[key]["listings"] = list(products[key]["listings"].values())
-            return list(products.values())
-                    
-        except Exception as e:
-            self.session.rollback()
-            raise e
+                    for listing in listings[row.listing_id]:
+                        listing["summary"] = summary
+            if listings and "series" in price_fields:
+                for row in session.execute(QUERY_RESULTS_SERIES, params):
+                    for listing in listings[row.listing_id]:
+                        listing["series"].append({
+                            "bucket_start": row.bucket_start,
+                            "min_price": row.min_price,
+                            "max_price": row.max_price,
+                            "avg_price": row.avg_price,
+                            "last_price": row.last_price,
+                        })
+            return list(products.values()), next_cursor
 
     def get_queries(self, client_id=None,client_email=None):
-        queries = self.session.query(Queries)
-
-        if client_id or client_email:
-            # Join with ClientQueries to include additional fields
-            if client_id:
-                queries = (
-                    queries.join(ClientQueries)
-                    .filter(ClientQueries.client_id == client_id)
-                    .with_entities(
-                        Queries.query_text,
-                        ClientQueries.pages_to_scrape,
-                        ClientQueries.frequency,
-                        Queries.created_at,
-                        Queries.removed_at,
-                        Queries.id
+        with self.session_scope() as session:
+            queries = session.query(Queries)
+
+            if client_id or client_email:
+                # Join with ClientQueries to include additional fields
+                if client_id:
+                    queries = (
+                        queries.join(ClientQueries)
+                        .filter(ClientQueries.client_id == client_id)
+                        .with_entities(
+                            Queries.query_text,
+                            ClientQueries.pages_to_scrape,
+                            ClientQueries.frequency,
+                            Queries.created_at,
+                            Queries.removed_at,
+                            Queries.id
+                        )
                     )
-                )
-            else:
-                queries = (
-                    queries.join(ClientQueries)
-                    .join(Clients)
-                    .filter(Clients.email == client_email)
-                    .with_entities(
-                        Queries.query_text,
-                        ClientQueries.pages_to_scrape,
-                        ClientQueries.frequency,
-                        Queries.created_at,
-                        Queries.removed_at,
-                        Queries.id
+                else:
+                    queries = (
+                        queries.join(ClientQueries)
+                        .join(Clients)
+                        .filter(Clients.email == client_email)
+                        .with_entities(
+                            Queries.query_text,
+                            ClientQueries.pages_to_scrape,
+                            ClientQueries.frequency,
+                            Queries.created_at,
+                            Queries.removed_at,
+                            Queries.id
+                        )
                     )
-                )
-            # Convert the result to a list of dictionaries
-            result = [
-                {
-                    "query_text": query_text,
-                    "pages_to_scrape": pages_to_scrape,
-                    "frequency": frequency,
-                    "created_at": created_at,
-                    "removed_at": removed_at,
-                    "query_id": id
-                }
-                for query_text, pages_to_scrape, frequency,created_at,removed_at,id in queries.all()
-            ]
-        else:
-            # If no client_id is provided, return only the query text
-            queries = queries.with_entities(Queries.query_text,
-                                            Queries.created_at,
-                                            Queries.removed_at,
-                                            Queries.id)
-            # Convert the result to a list of dictionaries
-            result = [{"query_text": query_text,
-                       "created_at": created_at,
-                    "removed_at": removed_at,
-                     "query_id":id } for query_text,created_at,removed_at,id in queries.all()]
-
-        return result
+                # Convert the result to a list of dictionaries
+                result = [
+                    {
+                        "query_text": query_text,
+                        "pages_to_scrape": pages_to_scrape,
+                        "frequency": frequency,
+                        "created_at": created_at,
+                        "removed_at": removed_at,
+                        "query_id": id
+                    }
+                    for query_text, pages_to_scrape, frequency,created_at,removed_at,id in queries.all()
+                ]
+            else:
+                # If no client_id is provided, return only the query text
+                queries = queries.with_entities(Queries.query_text,
+                                                Queries.created_at,
+                                                Queries.removed_at,
+                                                Queries.id)
+                # Convert the result to a list of dictionaries
+                result = [{"query_text": query_text,
+                           "created_at": created_at,
+                        "removed_at": removed_at,
+                         "query_id":id } for query_text,created_at,removed_at,id in queries.all()]
+
+            return result
     
     def get_all_clients(self):
         """
         Get all clients from the database
         """
-        try:
-            clients = self.session.query(Clients).all()
+        with self.session_scope() as session:
+            clients = session.query(Clients).all()
             return [serialize_model(client) for client in clients]
-        except Exception as e:
-            self.session.rollback()
-            raise e
+
+    def iter_all_clients(self, chunk_size:int = STREAM_CHUNK_SIZE):
+        """
+        Yields every client as a dict, read through a server-side cursor on a
+        dedicated connection so only `chunk_size` rows are in memory at a time.
+        """
+        with self.engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(
+                select(Clients.__table__).order_by(Clients.id)
+            )
+            for row in result.mappings():
+                yield dict(row)
+
+    def iter_query_results(self, query_id:int, since:datetime.datetime = None, fields:list = None,
+                           chunk_size:int = STREAM_CHUNK_SIZE):
+        """
+        Yields the products of a query one at a time, shaped like the items of
+        get_query_results but with their full price history (since `since`).
+        Rows are read through a server-side cursor and grouped on the fly, so at
+        most one product is held in memory.
+        """
+        listing_fields = RESULT_LISTING_FIELDS if not fields else [f for f in RESULT_LISTING_FIELDS if f in fields]
+        product = None
+        listing = None
+        with self.engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(
+                STREAM_QUERY_RESULTS, {"query_id": query_id, "since": since}
+            )
+            for row in result:
+                if product is None or product["id"] != row.product_id:
+                    if product is not None:
+                        yield product
+                    product = {"id": row.product_id, "name": row.name, "listings": []}
+                    listing = None
+                if listing is None or listing_id != row.id:
+                    listing_id = row.id
+                    listing = {field: getattr(row, field) for field in listing_fields if field != "prices"}
+                    if "prices" in listing_fields:
+                        listing["prices"] = []
+                    product["listings"].append(listing)
+                if "prices" in listing_fields and row.scraped_at is not None:
+                    listing["prices"].append({"price": row.price, "created_at": row.scraped_at})
+        if product is not None:
+            yield product
 
     def create_client(self, client_name: str, client_email: str)->dict:
-        try:
-            client = self.session.query(Clients).filter(Clients.email == client_email).first()
+        with self.session_scope() as session:
+            client = session.query(Clients).filter(Clients.email == client_email).first()
             if not client:
                 client = Clients(
                     name=client_name,
                     email=client_email
                 )
-                self.session.add(client)
-                self.safe_commit()  # Use safe_commit to handle rollback
+                session.add(client)
+                session.commit()
             else:
                 raise Exception('Client already exists')
             return serialize_model(client)
-        except Exception as e:
-            self.session.rollback()
-            raise e
 
     def post_query(self, query_text, client_id, frequency, pages_to_scrape)-> ClientQueries:
-        try:
-            query = self.session.query(Queries).filter(Queries.query_text == query_text).first()
+        with self.session_scope() as session:
+            query = session.query(Queries).filter(Queries.query_text == query_text).first()
             if not query:
                 query = Queries(
                     query_text=query_text
                 )
-                self.session.add(query)
-                self.safe_commit()  # Use safe_commit to handle rollback
+                session.add(query)
+                session.commit()
 
-            client_query = self.session.query(ClientQueries).filter(
+            client_query = session.query(ClientQueries).filter(
                 ClientQueries.client_id == client_id,
                 ClientQueries.query_id == query.id
             ).first()
@@ -327,12 +748,9 @@ class API():
                 frequency=frequency,
                 pages_to_scrape=pages_to_scrape
             )
-            self.session.add(client_query)
-            self.safe_commit()  # Use safe_commit to handle rollback
+            session.add(client_query)
+            session.commit()
             return client_query
-        except Exception as e:
-            self.session.rollback()
-            raise e
        
     async def get_listings(self, client_id:int):
         # Fetch the queries for the given client_id
@@ -360,138 +778,118 @@ class API():
         return listings_dict
         
     async def scrape_all(self):
-        try:
+        # Every DB step runs in a worker thread with its own session, the event loop keeps serving requests
+        queries, queries_map = await asyncio.to_thread(self.scrape_plan)
+        async with MercadoLibre(queries=queries, parse_workers=PARSE_WORKERS, page_cache=self.page_cache, adaptive_pagination=ADAPTIVE_PAGINATION) as scraper:
+            scraper.start_timer()
+            # Batches are matched and stored while the remaining pages are still being fetched
+            async with aclosing(scraper.iter_batches(batch_size=SCRAPE_BATCH_SIZE, max_in_flight=MAX_PAGES_IN_FLIGHT)) as batches:
+                async for batch in batches:
+                    await asyncio.to_thread(self.load_batch, batch, queries_map)
+                    # Only now the batch is committed: its pages can be skipped next time
+                    if self.page_cache is not None:
+                        self.page_cache.save(batch.attrs.get(PAGE_FINGERPRINTS, {}))
+            scraper.end_timer()
+        await asyncio.to_thread(self.mark_scraped, list(queries))
+        logger.info(f"Embedding cache stats: {self.embedding_cache.cache_stats()}")
+
+    def scrape_plan(self):
+        """
+        Pages to scrape per query text (the most any client asked for) and the
+        Queries rows by text, in one grouped query.
+        """
+        with self.session_scope() as session:
+            rows = session.execute(
+                select(Queries, func.max(ClientQueries.pages_to_scrape))
+                .join(ClientQueries, ClientQueries.query_id == Queries.id)
+                .group_by(Queries.id)
+            ).all()
+        queries = {query.query_text: pages for query, pages in rows}
+        queries_map = {query.query_text: query for query, _ in rows}
+        return queries, queries_map
+
+    def mark_scraped(self, query_texts:list):
+        with self.session_scope() as session:
+            mark_queries_scraped(session, query_texts)
+
+    def load_batch(self, data, queries_map:dict):
+        """
+        Match a batch of scraped listings to products and store it.
+        Runs in a worker thread with its own session.
+        """
+        with self.session_scope() as session:
             all_new_products = []
+            new_product_vectors = []
             all_products = []
             all_product_embeddings = []
 
-            products = self.session.query(ClientQueries).all()
-            queries = {}
-            # Print the fetched products
-            for product in products:
-                if product.query.query_text in queries:
-                    if product.pages_to_scrape > queries[product.query.query_text]:
-                        queries[product.query.query_text] = product.pages_to_scrape
-                else:
-                    queries[product.query.query_text] = product.pages_to_scrape
+            vectors = self.embedding_cache.encode(data["title"].astype(str).tolist())
+            # Near-identical titles of the batch share one lookup and at most one new product
+            nearest_products, clusters = find_nearest_clustered(session, vectors, index=self.product_index)
+            matched_ids = {n.product_id for n in nearest_products if n and n.distance < MATCH_DISTANCE_THRESHOLD}
+            matched_products = {
+                p.id: p for p in session.query(Products).filter(Products.id.in_(matched_ids)).all()
+            } if matched_ids else {}
+            # A match whose product is gone (deleted after the index was loaded) counts as
+            # no match: the listing gets a new product instead of failing the batch
+            missing = matched_ids - matched_products.keys()
+            if missing:
+                logger.warning(f"⚠️ Matched products no longer exist: {sorted(missing)}")
+                nearest_products = [n if n is None or n.product_id not in missing else None for n in nearest_products]
 
-            scraper = MercadoLibre(queries=queries)
-            await scraper.scrape()
-            await scraper.session.close()
-
-
-            for product in scraper.data.itertuples(index=False):
-                nearest_product = self.find_nearest_title(product)
-                if nearest_product and nearest_product.distance < 0.15:
-                    nearest_product = self.session.query(Products).filter(Products.id == nearest_product.product_id).first()
+            new_by_cluster = {}
+            for product, vector, cluster, nearest_product in zip(data.itertuples(index=False), vectors, clusters, nearest_products):
+                if nearest_product and nearest_product.distance < MATCH_DISTANCE_THRESHOLD:
+                    nearest_product = matched_products[nearest_product.product_id]
+                elif cluster in new_by_cluster:
+                    nearest_product = new_by_cluster[cluster]
                 else:
                     nearest_product = Products(
                         name = product.title,
                     )
+                    new_by_cluster[cluster] = nearest_product
                     all_new_products.append(nearest_product)
+                    new_product_vectors.append(vector)
                 all_products.append(nearest_product)
-                        
-                    
+
             if len(all_new_products) != 0:
-                self.session.add_all(all_new_products)
-                self.safe_commit() 
-            for product in all_new_products:
+                session.add_all(all_new_products)
+                safe_commit(session)
+            # Reuse the vector the title was matched with instead of encoding the name again
+            for product, vector in zip(all_new_products, new_product_vectors):
                 emb = ProductEmbeddings(
                     product_id = product.id,
-                    embedding = list(map(float,self.model.encode(product.name, normalize_embeddings=True)))
+                    embedding = list(map(float, vector))
                 )
                 all_product_embeddings.append(emb)
             if len(all_product_embeddings) != 0:
-                self.session.add_all(all_product_embeddings)
-                self.safe_commit()
-
-            queries = self.session.query(Queries).filter(Queries.query_text.in_(queries.keys())).all()
-            queries = {query.query_text: query for query in queries}
-            new_candidates = []
-            new_listings = []
-            all_listings = {}
-            safe_commit = False
-            for i,product in enumerate(scraper.data.itertuples(index=False)):
-                listing = self.find_listing_by_ml_id(product)
-                if not listing:
-                    try:
-                        distance = all_products[i].distance
-                    except:
-                        distance = 0.0
-                    listing = Listings(
-                        external_id = product.ml_id,
-                        title = product.title,
-                        url = product.url,
-                        marketplace_id = 1,
-                        img_url = product.img_url
-                    )
-                    new_listings.append(listing)
-                    
-                    for query in product.query.split("-QUERYSEP-"):
-                        if query not in queries:
-                            continue
-                        query = queries[query]
-                        candidate = ProductCandidates(
-                            query_id = query.id,
-                            product_id = all_products[i].id,
-                            match_method = 'cosine',
-                            distance = distance,
-                            decided = False,
-                            listing = listing
-                        )
-                        new_candidates.append(candidate)
-                elif listing.img_url != product.img_url:
-                    listing.img_url = product.img_url
-                    safe_commit = True
-                all_listings[product] = listing
-            if len(new_listings) != 0:
-                self.session.add_all(new_listings)
-                safe_commit = True
-            if safe_commit:
-                self.safe_commit()
-            
-            for candidate in new_candidates:    
-                candidate.listing_id = candidate.listing.id
-            if len(new_candidates) != 0:
-                self.session.add_all(new_candidates)
-                self.safe_commit()
-
-            all_prices = []
-            for product,listing in all_listings.items():
-                price = Prices(
-                    listing_id = listing.id,
-                    price = float(product.price)
-                )
-                all_prices.append(price)
-            self.session.add_all(all_prices)
-            self.safe_commit()  # Use safe_commit to handle rollback
-        except Exception as e:
-            self.session.rollback()
-            raise e
+                session.add_all(all_product_embeddings)
+                safe_commit(session)
+                if self.product_index is not None:
+                    self.product_index.add([product.id for product in all_new_products], new_product_vectors)
+
+            distances = [
+                n.distance if n and n.distance < MATCH_DISTANCE_THRESHOLD else 0.0
+                for n in nearest_products
+            ]
+            ingest(
+                session,
+                data,
+                [product.id for product in all_products],
+                distances,
+                queries_map
+            )
 
     def find_listing_by_ml_id(self,product):
         return self.session.query(Listings).filter(Listings.external_id == product.ml_id , Listings.marketplace_id == 1).first()
-    def find_nearest_title(self,product):
-        # Encode the product title into a vector
-        query_vector = self.model.encode(product.title, normalize_embeddings=True)
-        query_vector = list(map(float, query_vector))  # Ensure it's a list of floats
-
-        # Convert the query vector into a PostgreSQL-compatible array and cast it to 'vector'
-        query_vector_str = ','.join(map(str, query_vector))
-
-        # Raw SQL query
-        raw_query = text(f"""
-                        SELECT 
-                            product_id, 
-                            embedding, 
-                            embedding <=> '[{query_vector_str}]'::vector AS distance  -- Using <=> for HNSW search
-                        FROM 
-                            product_embeddings
-                        ORDER BY 
-                            distance  -- Orders by closest match
-                        LIMIT 5;    -- Limits the results to the top 5 closest matches
-                    """)
-        return self.session.execute(raw_query).first()
+    def find_nearest_title(self,product, ef_search:int = MATCH_EF_SEARCH):
+        """
+        Nearest product (product_id, distance) of a single listing, None when there
+        are no products. Runs the prepared top-k statement of matching.nearest_products.
+        """
+        query_vector = self.embedding_cache.get(product.title)
+        nearest = nearest_products(self.session, query_vector, k=1, ef_search=ef_search)
+        return nearest[0] if nearest else None
     def __del__(self):
         # rollback any uncommitted transactions
         try:
@@ -511,4 +909,5 @@ class API():
 
 if __name__ == "__main__":
     api = API()
+    api.warm_up()
     asyncio.run(api.scrape_all())
@@ -0,0 +1,104 @@
+import aiohttp
+import logging
+
+logger = logging.getLogger("connections")
+
+class ConnectionManager:
+    """
+    Owns the aiohttp session and its pooled TCPConnector: per-host limits,
+    keep-alive, DNS caching and compressed responses. The session is replaced
+    (and the old one closed) after too many consecutive connection failures.
+    """
+    def __init__(self, session:aiohttp.ClientSession = None, limit:int = 100, limit_per_host:int = 20,
+                 keepalive_timeout:float = 30, dns_cache_ttl:int = 300, max_consecutive_failures:int = 5):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.max_consecutive_failures = max_consecutive_failures
+        # A session passed in by the caller is used as is and never closed here
+        self.session:aiohttp.ClientSession = session
+        self.owns_session = session is None
+        self.consecutive_failures = 0
+        self.stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "dns_cache_hits": 0,
+            "dns_cache_misses": 0,
+            "recycled_sessions": 0,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        def counter(name):
+            async def increment(session, context, params):
+                self.stats[name] += 1
+            return increment
+
+        trace.on_request_end.append(counter("requests"))
+        trace.on_connection_create_end.append(counter("connections_created"))
+        trace.on_connection_reuseconn.append(counter("connections_reused"))
+        trace.on_dns_cache_hit.append(counter("dns_cache_hits"))
+        trace.on_dns_cache_miss.append(counter("dns_cache_misses"))
+        return trace
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+            enable_cleanup_closed=True,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            trace_configs=[self._trace_config()],
+            headers={"Accept-Encoding": "gzip, deflate"},
+            auto_decompress=True,
+        )
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the live session, creating it on first use (inside the event loop).
+        """
+        if self.session is None or (self.owns_session and self.session.closed):
+            self.session = self._create_session()
+        return self.session
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    async def record_failure(self):
+        """
+        Counts a connection level failure and recycles the session when the
+        threshold is reached.
+        """
+        self.consecutive_failures += 1
+        if self.owns_session and self.consecutive_failures >= self.max_consecutive_failures:
+            await self.recycle()
+
+    async def recycle(self):
+        """
+        Closes the current session and its pooled connections and opens a fresh one.
+        """
+        logger.warning(f"Recycling HTTP session after {self.consecutive_failures} consecutive failures")
+        old = self.session
+        self.session = self._create_session()
+        self.consecutive_failures = 0
+        self.stats["recycled_sessions"] += 1
+        if old is not None and not old.closed:
+            await old.close()
+
+    def connection_stats(self) -> dict:
+        stats = dict(self.stats)
+        created = stats["connections_created"]
+        reused = stats["connections_reused"]
+        stats["reuse_ratio"] = round(reused / (created + reused), 3) if created + reused else 0.0
+        return stats
+
+    async def close(self):
+        if self.owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
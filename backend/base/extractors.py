@@ -0,0 +1,203 @@
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+import os
+import re
+
+from bs4 import BeautifulSoup
+
+# Optional fast backends
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser
+    except ImportError:
+        HTMLParser = None
+
+TOTAL_RESULTS = re.compile(r'ui-search-search-result__quantity-results[^>]*>\s*([\d.,]+)')
+
+class ListingRecord(NamedTuple):
+    """
+    Compact listing extracted from a search results page.
+    """
+    title: str
+    price: float
+    ml_id: str
+    url: str
+    img_url: str
+
+def parse_ml_id(url:str) -> str:
+    if "/p/" in url:
+        return url.split("/p/")[-1]
+    ml_id = url.split("/")[3]
+    ml_id = ml_id.split("-")
+    return "".join(ml_id[0:2])
+
+def parse_price(text:str) -> float:
+    return float(text.replace(".", "").replace(",", "."))
+
+def build_record(href:str, title:str, src:str, data_src:str, price:str):
+    """
+    Applies the MercadoLibre specific rules shared by every backend.
+    Returns None for ads that are not part of the search results.
+    """
+    url = href.split("#")[0]
+    if "mclics" in url: #ads that are not from the search
+        return None
+    img_url = data_src if src and "data" in src else src
+    return ListingRecord(title, parse_price(price), parse_ml_id(url), url, img_url)
+
+class ListingExtractor(ABC):
+    """
+    Extracts ListingRecords from the HTML of a search results page.
+    """
+    name = None
+
+    @abstractmethod
+    def extract(self, html:str) -> list:
+        pass
+
+    def extract_total(self, html:str):
+        """
+        Total result count announced by the page ("1.234 resultados"), None if absent.
+        """
+        match = TOTAL_RESULTS.search(html) if html else None
+        if not match:
+            return None
+        return int(match.group(1).replace(".", "").replace(",", ""))
+
+class SoupExtractor(ListingExtractor):
+    """
+    BeautifulSoup backend, works with "html.parser" or "lxml" as tree builder.
+    """
+    name = "soup"
+
+    def __init__(self, parser:str = "html.parser"):
+        self.parser = parser
+
+    def extract(self, html:str) -> list:
+        records = []
+        if not html:
+            return records
+        soup = BeautifulSoup(html, self.parser)
+        for li in soup.find_all("li", {"class": "ui-search-layout__item"}):
+            try:
+                a = li.find("a")
+                img = li.find("div", {"class": "poly-card__portada"}).find("img")
+                record = build_record(
+                    a.attrs["href"],
+                    a.text,
+                    img.attrs.get("src"),
+                    img.attrs.get("data-src"),
+                    li.find("span", {"class": "andes-money-amount__fraction"}).text
+                )
+            except (AttributeError, KeyError, IndexError, ValueError):
+                continue
+            if record:
+                records.append(record)
+        return records
+
+class LxmlExtractor(ListingExtractor):
+    """
+    lxml backend using XPath, no soup tree is built.
+    """
+    name = "lxml"
+    ITEM = "//li[contains(concat(' ', normalize-space(@class), ' '), ' ui-search-layout__item ')]"
+    IMG = ".//div[contains(concat(' ', normalize-space(@class), ' '), ' poly-card__portada ')]//img"
+    PRICE = ".//span[contains(concat(' ', normalize-space(@class), ' '), ' andes-money-amount__fraction ')]"
+
+    def __init__(self):
+        if lxml is None:
+            raise ImportError("The 'lxml' extractor requires the lxml package")
+
+    def extract(self, html:str) -> list:
+        records = []
+        if not html:
+            return records
+        tree = lxml.html.fromstring(html)
+        for li in tree.xpath(self.ITEM):
+            try:
+                a = li.xpath(".//a")[0]
+                img = li.xpath(self.IMG)[0]
+                record = build_record(
+                    a.get("href"),
+                    a.text_content(),
+                    img.get("src"),
+                    img.get("data-src"),
+                    li.xpath(self.PRICE)[0].text_content()
+                )
+            except (AttributeError, KeyError, IndexError, ValueError):
+                continue
+            if record:
+                records.append(record)
+        return records
+
+class SelectolaxExtractor(ListingExtractor):
+    """
+    selectolax (lexbor) backend using CSS selectors.
+    """
+    name = "selectolax"
+
+    def __init__(self):
+        if HTMLParser is None:
+            raise ImportError("The 'selectolax' extractor requires the selectolax package")
+
+    def extract(self, html:str) -> list:
+        records = []
+        if not html:
+            return records
+        tree = HTMLParser(html)
+        for li in tree.css("li.ui-search-layout__item"):
+            try:
+                a = li.css_first("a")
+                img = li.css_first("div.poly-card__portada img")
+                record = build_record(
+                    a.attributes["href"],
+                    a.text(),
+                    img.attributes.get("src"),
+                    img.attributes.get("data-src"),
+                    li.css_first("span.andes-money-amount__fraction").text()
+                )
+            except (AttributeError, KeyError, IndexError, ValueError):
+                continue
+            if record:
+                records.append(record)
+        return records
+
+EXTRACTORS = {
+    "soup": SoupExtractor,
+    "lxml": LxmlExtractor,
+    "selectolax": SelectolaxExtractor,
+}
+
+def get_extractor(name:str = None) -> ListingExtractor:
+    """
+    Returns an extractor by name. "auto" (the default, or HTML_EXTRACTOR env var)
+    picks the fastest installed backend.
+    """
+    name = name or os.getenv("HTML_EXTRACTOR", "auto")
+    if name == "auto":
+        if HTMLParser is not None:
+            return SelectolaxExtractor()
+        if lxml is not None:
+            return LxmlExtractor()
+        return SoupExtractor()
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown extractor '{name}', expected one of {list(EXTRACTORS)} or 'auto'")
+    return EXTRACTORS[name]()
+
+# Extractors built inside process pool workers, one per backend name
+_worker_extractors = {}
+
+def extract_records(html:str, name:str = None) -> list:
+    """
+    Process pool entry point: parses a page and returns plain record tuples
+    (title, price, ml_id, url, img_url) so only compact data is pickled back.
+    """
+    if name not in _worker_extractors:
+        _worker_extractors[name] = get_extractor(name)
+    return [tuple(record) for record in _worker_extractors[name].extract(html)]
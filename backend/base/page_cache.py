@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from typing import NamedTuple
+import hashlib
+import time
+
+class CacheEntry(NamedTuple):
+    etag: str
+    last_modified: str
+    content_hash: str
+    size: int
+    stored_at: float
+
+def listing_set_hash(records) -> str:
+    """
+    Order independent hash of the listings extracted from a page.
+    """
+    digest = hashlib.sha1()
+    for record in sorted((r["ml_id"], r["title"], repr(r["price"]), r["url"], r["img_url"] or "") for r in records):
+        digest.update("\x1f".join(record).encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+class PageCache:
+    """
+    LRU cache of page fingerprints keyed by URL. Stores the validators sent
+    back by the server (ETag / Last-Modified) and a hash of the extracted
+    listing set so unchanged pages can skip parsing and DB work.
+    Bounded by `max_entries` (least recently used are evicted first) and
+    optionally by `max_age` seconds.
+    """
+    def __init__(self, max_entries:int = 10000, max_age:float = None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries:OrderedDict = OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "not_modified": 0,
+            "unchanged": 0,
+            "bytes_saved": 0,
+            "evictions": 0,
+        }
+
+    def get(self, url:str) -> CacheEntry:
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if self.max_age is not None and time.time() - entry.stored_at > self.max_age:
+            del self.entries[url]
+            self.stats["evictions"] += 1
+            return None
+        self.entries.move_to_end(url)
+        return entry
+
+    def conditional_headers(self, url:str) -> dict:
+        """
+        If-None-Match / If-Modified-Since headers for a conditional request.
+        """
+        entry = self.get(url)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def record_not_modified(self, url:str):
+        """
+        The server answered 304: the body was not downloaded at all.
+        """
+        entry = self.get(url)
+        self.stats["hits"] += 1
+        self.stats["not_modified"] += 1
+        if entry is not None:
+            self.stats["bytes_saved"] += entry.size
+
+    def check(self, url:str, records:list, etag:str = None, last_modified:str = None, size:int = 0) -> CacheEntry:
+        """
+        Fingerprints a freshly downloaded page. Returns None when its listing set
+        is identical to the cached one (the cached entry is refreshed), otherwise
+        the new entry, which is only stored by `save` once the listings are in
+        the database: a page whose batch failed to load is not skipped next time.
+        """
+        content_hash = listing_set_hash(records)
+        previous = self.get(url)
+        entry = CacheEntry(etag, last_modified, content_hash, size, time.time())
+        if previous is not None and previous.content_hash == content_hash:
+            self.stats["hits"] += 1
+            self.stats["unchanged"] += 1
+            self.store(url, entry)
+            return None
+        self.stats["misses"] += 1
+        return entry
+
+    def save(self, fingerprints:dict):
+        """
+        Stores the {url: CacheEntry} fingerprints of pages whose listings were loaded.
+        """
+        for url, entry in fingerprints.items():
+            self.store(url, entry)
+
+    def store(self, url:str, entry:CacheEntry):
+        self.entries[url] = entry
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def update(self, url:str, records:list, etag:str = None, last_modified:str = None, size:int = 0) -> bool:
+        """
+        Fingerprints and stores a page at once.
+        Returns False when its listing set is identical to the cached one.
+        """
+        entry = self.check(url, records, etag, last_modified, size)
+        if entry is None:
+            return False
+        self.store(url, entry)
+        return True
+
+    def cache_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,72 @@
+"""
+Cold-start time of the API: starts `uvicorn main:app` (from backend/) and
+measures the time to the first 200 from /health (process serving) and from
+/ready (embedding model and ANN index loaded). Repeated `--runs` times.
+
+    python benchmarks/cold_start.py --runs 3
+    API_WARMUP=false python benchmarks/cold_start.py --no-ready
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+def wait_for(url: str, started: float, timeout: float) -> float:
+    """
+    Polls `url` until it answers 200, returns the seconds since `started`.
+    """
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError, TimeoutError):
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f"{url} did not answer 200 within {timeout}s")
+
+
+def cold_start(port: int, ready: bool, timeout: float) -> dict:
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=backend,
+    )
+    try:
+        result = {"health": wait_for(url + "/health", started, timeout)}
+        if ready:
+            result["ready"] = wait_for(url + "/ready", started, timeout)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for each endpoint")
+    parser.add_argument("--no-ready", action="store_true", help="only measure the time to /health")
+    args = parser.parse_args()
+
+    runs = []
+    for run in range(args.runs):
+        result = cold_start(args.port, not args.no_ready, args.timeout)
+        runs.append(result)
+        print(f"run {run + 1}: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in result.items()))
+    for name in runs[0]:
+        values = [r[name] for r in runs]
+        print(f"{name:>7}: median {statistics.median(values):.2f}s, min {min(values):.2f}s, max {max(values):.2f}s")
+
+
+if __name__ == "__main__":
+    main()
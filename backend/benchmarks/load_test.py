@@ -0,0 +1,130 @@
+"""
+Concurrency load test of the read endpoints. Runs `--concurrency` clients in a
+closed loop for `--duration` seconds each and reports requests/sec and latency.
+
+Against a running server:
+
+    python benchmarks/load_test.py --url http://localhost:8000 --concurrency 1,8,32,64
+
+Or let the script start `uvicorn main:app` once per worker count (run from backend/,
+DATABASE_URL pointing at a populated database):
+
+    python benchmarks/load_test.py --workers 1,2,4 --concurrency 8,32,64 \
+        --path "/query/results?query_id=1" --path /client
+
+Pool and threadpool sizes come from the server environment (DB_POOL_SIZE,
+DB_MAX_OVERFLOW, API_THREADPOOL_SIZE), so they can be varied between runs.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+
+async def client_loop(session, url: str, paths: list, deadline: float, latencies: list, errors: list):
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            async with session.get(url + path) as response:
+                await response.read()
+                if response.status >= 400:
+                    errors.append(response.status)
+                    continue
+        except aiohttp.ClientError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_level(url: str, paths: list, concurrency: int, duration: float) -> dict:
+    latencies, errors = [], []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            client_loop(session, url, paths, deadline, latencies, errors) for _ in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0,
+    }
+
+
+async def sweep(url: str, paths: list, levels: list, duration: float, label: str):
+    print(f"\n{label}")
+    print(f"{'clients':>8}  {'requests':>9}  {'errors':>7}  {'req/s':>8}  {'p50 ms':>8}  {'p95 ms':>8}")
+    for concurrency in levels:
+        r = await run_level(url, paths, concurrency, duration)
+        print(f"{r['concurrency']:>8}  {r['requests']:>9}  {r['errors']:>7}  {r['rps']:>8.1f}  {r['p50']:>8.1f}  {r['p95']:>8.1f}")
+
+
+async def wait_ready(url: str, timeout: float):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(url + "/health") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} did not become healthy within {timeout}s")
+
+
+def start_server(workers: int, port: int):
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=backend,
+    )
+
+
+def parse_ints(value: str) -> list:
+    return [int(v) for v in value.split(",")]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="server to test (ignored with --workers)")
+    parser.add_argument("--path", action="append", help="endpoint to request, repeatable (default /query)")
+    parser.add_argument("--concurrency", type=parse_ints, default=[1, 4, 16, 64], help="comma separated client counts")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--workers", type=parse_ints, help="comma separated uvicorn worker counts to start and test")
+    parser.add_argument("--port", type=int, default=8765, help="port of the servers started with --workers")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="seconds to wait for a started server")
+    args = parser.parse_args()
+    paths = args.path or ["/query"]
+
+    if not args.workers:
+        await sweep(args.url, paths, args.concurrency, args.duration, args.url)
+        return
+    url = f"http://127.0.0.1:{args.port}"
+    for workers in args.workers:
+        server = start_server(workers, args.port)
+        try:
+            await wait_ready(url, args.startup_timeout)
+            await sweep(url, paths, args.concurrency, args.duration, f"{workers} uvicorn worker(s)")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
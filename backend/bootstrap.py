@@ -0,0 +1,30 @@
+"""
+One-shot database bootstrap: pgvector extension, enum types, tables, the
+schema changes of later migrations (columns, price_rollups backfill, indexes)
+and the basic marketplace rows. Idempotent, run it before starting the API:
+
+    python bootstrap.py && uvicorn main:app
+"""
+import logging
+import sys
+import time
+
+from api import API
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("bootstrap")
+
+
+def main():
+    started = time.perf_counter()
+    api = API()
+    try:
+        api.initialize_database()
+    except Exception:
+        return 1
+    logger.info(f"✅ Database bootstrapped in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
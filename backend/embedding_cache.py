@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger("embedding_cache")
+
+# Vectors kept in memory (least recently used are evicted first)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "50000"))
+# Optional sqlite file persisting vectors across runs (empty keeps the cache in memory only)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+
+
+def normalize_title(title) -> str:
+    """
+    Case and whitespace insensitive form of a title. all-MiniLM-L6-v2 is uncased,
+    so titles that only differ in these get the same vector anyway.
+    """
+    return " ".join(str(title).lower().split())
+
+
+def title_key(title) -> str:
+    return hashlib.sha1(normalize_title(title).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Title -> vector cache in front of a SentenceTransformer. Entries are keyed by
+    a hash of the normalized title, kept in an LRU map bounded by `max_entries`
+    and optionally persisted to a sqlite file at `path`. Vectors are normalized
+    so the same vector serves both matching and the ProductEmbeddings rows.
+    Safe to share between the threads encoding and loading batches.
+    With encoder=None, `loader` is called to load it the first time a title
+    actually needs encoding.
+    """
+
+    def __init__(self, encoder, max_entries: int = EMBEDDING_CACHE_SIZE, path: str = EMBEDDING_CACHE_PATH,
+                 loader=None):
+        self.encoder = encoder
+        self.loader = loader
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.store = None
+        if path:
+            self.store = sqlite3.connect(path, check_same_thread=False)
+            self.store.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self.store.commit()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "encoded": 0, "evictions": 0}
+
+    def encode(self, titles) -> np.ndarray:
+        """
+        Returns one float32 vector per title (aligned with `titles`). Only titles
+        missing from memory and disk are encoded, in a single batch.
+        """
+        titles = list(titles)
+        keys = [title_key(title) for title in titles]
+        vectors = {}
+        with self.lock:
+            for key in keys:
+                if key in vectors:
+                    continue
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    vectors[key] = vector
+                    self.stats["hits"] += 1
+            missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+            for key, vector in self._load(missing).items():
+                vectors[key] = vector
+                self._remember(key, vector)
+                self.stats["disk_hits"] += 1
+
+        to_encode = {}
+        for key, title in zip(keys, titles):
+            if key not in vectors:
+                to_encode.setdefault(key, normalize_title(title))
+        if to_encode:
+            if self.encoder is None and self.loader is not None:
+                self.encoder = self.loader()
+            if self.encoder is None:
+                raise RuntimeError("No embedding model loaded")
+            encoded = self.encoder.encode(list(to_encode.values()), normalize_embeddings=True, show_progress_bar=False)
+            encoded = np.asarray(encoded, dtype=np.float32)
+            with self.lock:
+                for key, vector in zip(to_encode, encoded):
+                    vectors[key] = vector
+                    self._remember(key, vector)
+                self._save({key: vectors[key] for key in to_encode})
+                self.stats["misses"] += len(to_encode)
+                self.stats["encoded"] += len(to_encode)
+
+        if not titles:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    def get(self, title) -> np.ndarray:
+        return self.encode([title])[0]
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _load(self, keys: list) -> dict:
+        if self.store is None or not keys:
+            return {}
+        found = {}
+        # Stay below sqlite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.store.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        return found
+
+    def _save(self, vectors: dict):
+        if self.store is None or not vectors:
+            return
+        self.store.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(key, vector.tobytes()) for key, vector in vectors.items()]
+        )
+        self.store.commit()
+
+    def cache_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "hit_ratio": round((lookups - self.stats["misses"]) / lookups, 3) if lookups else 0.0,
+        }
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
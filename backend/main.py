@@ -1,19 +1,41 @@
-from fastapi import FastAPI, HTTPException,Query
+from fastapi import FastAPI, HTTPException,Query, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import uvicorn
-from api import API
+from api import API, API_WARMUP, DB_MAX_OVERFLOW, DB_POOL_SIZE, RESULTS_LISTINGS_PER_PRODUCT, RESULTS_PAGE_SIZE, RESULTS_PRICES_PER_LISTING, RESULTS_SERIES_BUCKETS
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 import asyncio
+import anyio.to_thread
+import datetime
+import json
 import logging
+import os
+from typing import Literal
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("main")
 
+# Threads running the sync endpoints, by default one per pooled connection so
+# requests do not queue on the pool while holding a thread
+API_THREADPOOL_SIZE = int(os.getenv("API_THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
 api = API()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
+    logger.info(f"✅ Serving sync endpoints with {API_THREADPOOL_SIZE} threads, pool {api.pool_status()}")
+    # The model and ANN index load off the critical path; /ready turns 200 once they are done
+    if API_WARMUP:
+        api.start_warm_up()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.add_middleware(
@@ -22,10 +44,29 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 tasks = []
 
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+
+def stream_items(items, format:str):
+    """
+    Serializes an iterator of dicts as NDJSON lines or as a JSON array sent in
+    chunks. It is a sync generator, so StreamingResponse runs it (and the DB
+    reads behind `items`) in the threadpool.
+    """
+    if format == "ndjson":
+        for item in items:
+            yield json.dumps(jsonable_encoder(item)) + "\n"
+        return
+    yield "["
+    for i, item in enumerate(items):
+        yield ("," if i else "") + json.dumps(jsonable_encoder(item))
+    yield "]"
+
 
 class QueryRequest(BaseModel):
     query_text: str
@@ -36,24 +77,80 @@ class QueryRequest(BaseModel):
 @app.get("/health")
 async def health_check():
     logger.info("🏥 Health check endpoint called")
-    health_status = {"status": "healthy", "message": "Service is running"}
+    health_status = {"status": "healthy", "message": "Service is running", "pool": api.pool_status()}
     logger.info(f"🏥 Health check response: {health_status}")
     return health_status
 
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """
+    200 once the embedding model and ANN index are loaded, 503 before (or if
+    warm-up failed). With API_WARMUP=false they load on first use instead.
+    """
+    readiness = api.readiness()
+    if not readiness["ready"]:
+        response.status_code = 503
+    return readiness
+
 @app.get("/")
 async def hello_world():
     return {"message": "Hello, World!"}
 
 @app.get('/query')
-async def get_queries(client_id:int = Query(None),client_email:str = Query(None)):
+def get_queries(client_id:int = Query(None),client_email:str = Query(None)):
     queries = api.get_queries(client_id=client_id, client_email=client_email)
     return queries
 @app.get('/query/results')
-async def get_query_results(query_id:int = Query(None)):
-    results = api.get_query_results(query_id=query_id)
+def get_query_results(
+    response: Response,
+    query_id:int = Query(None),
+    limit:int = Query(RESULTS_PAGE_SIZE, ge=1, le=500),
+    cursor:str = Query(None, description="X-Next-Cursor header of the previous page"),
+    since:datetime.datetime = Query(None, description="Only prices scraped at or after this time"),
+    fields:str = Query(None, description="Comma separated listing fields, e.g. id,title,url,prices"),
+    listings_per_product:int = Query(RESULTS_LISTINGS_PER_PRODUCT, ge=1, le=500),
+    prices_per_listing:int = Query(RESULTS_PRICES_PER_LISTING, ge=1, le=1000),
+    view:Literal["prices", "summary"] = Query("prices", description="summary returns per-listing aggregates instead of raw prices"),
+    bucket:Literal["hour", "day", "week"] = Query("day", description="Aggregation bucket of the summary view"),
+    buckets:int = Query(RESULTS_SERIES_BUCKETS, ge=1, le=1000, description="Series points per listing in the summary view"),
+):
+    """
+    Products of a query, one keyset page at a time. The body is the same list as
+    before; the cursor of the next page (if any) is sent in the X-Next-Cursor header.
+    """
+    try:
+        results, next_cursor = api.get_query_results(
+            query_id=query_id,
+            limit=limit,
+            cursor=cursor,
+            since=since,
+            fields=fields.split(",") if fields else None,
+            listings_per_product=listings_per_product,
+            prices_per_listing=prices_per_listing,
+            view=view,
+            bucket=bucket,
+            buckets=buckets
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return results
+@app.get('/query/results/stream')
+async def stream_query_results(
+    query_id:int = Query(...),
+    since:datetime.datetime = Query(None, description="Only prices scraped at or after this time"),
+    fields:str = Query(None, description="Comma separated listing fields, e.g. id,title,url,prices"),
+    format:Literal["ndjson", "json"] = Query("ndjson"),
+):
+    """
+    Every product of a query with its full price history, streamed one product
+    at a time as NDJSON (or as a chunked JSON array with format=json).
+    """
+    items = api.iter_query_results(query_id=query_id, since=since, fields=fields.split(",") if fields else None)
+    return StreamingResponse(stream_items(items, format), media_type=STREAM_MEDIA_TYPES[format])
 @app.post("/query")
-async def create_query(body: QueryRequest):
+def create_query(body: QueryRequest):
     logger.info(f"Creating query: {body}")
     # Placeholder for query creation logic
     # Replace with actual query creation logic
@@ -69,7 +166,7 @@ class ClientRequest(BaseModel):
     client_name: str
     client_email: str
 @app.get("/client")
-async def get_all_clients():
+def get_all_clients():
     """
     Get all clients
     """
@@ -79,8 +176,15 @@ async def get_all_clients():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/client/stream")
+async def stream_all_clients(format:Literal["ndjson", "json"] = Query("ndjson")):
+    """
+    All clients, streamed from a server-side cursor.
+    """
+    return StreamingResponse(stream_items(api.iter_all_clients(), format), media_type=STREAM_MEDIA_TYPES[format])
+
 @app.post("/client")
-async def create_client(body: ClientRequest):
+def create_client(body: ClientRequest):
     try:
         client = api.create_client(body.client_name, body.client_email)
         return {"message": "Client created successfully","client": client}
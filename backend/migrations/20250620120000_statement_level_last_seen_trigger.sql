@@ -0,0 +1,34 @@
+-- +goose Up
+-- +goose StatementBegin
+-- Bulk price loads fired one UPDATE per inserted row; update every touched
+-- listing once per INSERT statement instead.
+DROP TRIGGER IF EXISTS trigger_update_listings_updated_at ON prices;
+
+CREATE OR REPLACE FUNCTION update_listings_last_seen()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE listings
+    SET last_seen = NOW()
+    FROM (SELECT DISTINCT listing_id FROM new_prices) touched
+    WHERE listings.id = touched.listing_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_update_listings_last_seen
+AFTER INSERT ON prices
+REFERENCING NEW TABLE AS new_prices
+FOR EACH STATEMENT
+EXECUTE FUNCTION update_listings_last_seen();
+-- +goose StatementEnd
+
+-- +goose Down
+-- +goose StatementBegin
+DROP TRIGGER IF EXISTS trigger_update_listings_last_seen ON prices;
+DROP FUNCTION IF EXISTS update_listings_last_seen();
+
+CREATE TRIGGER trigger_update_listings_updated_at
+AFTER INSERT ON prices
+FOR EACH ROW
+EXECUTE FUNCTION update_listings_updated_at();
+-- +goose StatementEnd
@@ -0,0 +1,24 @@
+-- +goose NO TRANSACTION
+-- +goose Up
+-- Quantized HNSW indexes used by MATCH_PRECISION=halfvec|binary (pgvector >= 0.7).
+-- The table keeps the float32 embeddings for the full precision re-rank, only
+-- the indexes store the compact halfvec (2 bytes/dim) and bit (1 bit/dim) forms.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_embeddings_halfvec_idx
+ON product_embeddings
+USING hnsw ((embedding::halfvec(384)) halfvec_cosine_ops)
+WITH (
+    m = 16,
+    ef_construction = 64
+);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_embeddings_binary_idx
+ON product_embeddings
+USING hnsw ((binary_quantize(embedding)::bit(384)) bit_hamming_ops)
+WITH (
+    m = 16,
+    ef_construction = 64
+);
+
+-- +goose Down
+DROP INDEX CONCURRENTLY IF EXISTS product_embeddings_binary_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_embeddings_halfvec_idx;
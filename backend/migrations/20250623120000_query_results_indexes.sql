@@ -0,0 +1,13 @@
+-- +goose NO TRANSACTION
+-- +goose Up
+-- Keyset pages of /query/results: product ids of a query in order, the
+-- candidates of one product and the latest prices of one listing.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS product_candidates_query_product_idx
+ON product_candidates (query_id, product_id, listing_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS prices_listing_scraped_at_idx
+ON prices (listing_id, scraped_at DESC, id DESC);
+
+-- +goose Down
+DROP INDEX CONCURRENTLY IF EXISTS prices_listing_scraped_at_idx;
+DROP INDEX CONCURRENTLY IF EXISTS product_candidates_query_product_idx;
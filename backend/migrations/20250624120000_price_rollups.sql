@@ -0,0 +1,44 @@
+-- +goose Up
+-- +goose StatementBegin
+-- Hour/day/week price aggregates per listing, kept up to date by ingest
+-- (update_price_rollups) in the same transaction as the prices themselves.
+CREATE TABLE IF NOT EXISTS price_rollups (
+    listing_id TEXT NOT NULL,
+    bucket_width TEXT NOT NULL,  -- 'hour', 'day' or 'week'
+    bucket_start TIMESTAMP NOT NULL,
+    min_price NUMERIC,
+    max_price NUMERIC,
+    sum_price NUMERIC,
+    price_count INT NOT NULL DEFAULT 0,
+    last_price NUMERIC,
+    last_scraped_at TIMESTAMP,
+    CONSTRAINT price_rollups_pkey PRIMARY KEY (listing_id, bucket_width, bucket_start),
+    CONSTRAINT price_rollups_listing_id_fkey FOREIGN KEY (listing_id) REFERENCES listings(id) ON DELETE CASCADE
+);
+
+-- Backfill from the existing price history
+INSERT INTO price_rollups (
+    listing_id, bucket_width, bucket_start, min_price, max_price,
+    sum_price, price_count, last_price, last_scraped_at
+)
+SELECT
+    p.listing_id,
+    w.width,
+    date_trunc(w.width, p.scraped_at),
+    min(p.price),
+    max(p.price),
+    sum(p.price),
+    count(p.price),
+    (array_agg(p.price ORDER BY p.scraped_at DESC, p.id DESC))[1],
+    max(p.scraped_at)
+FROM prices p
+CROSS JOIN (VALUES ('hour'), ('day'), ('week')) AS w(width)
+WHERE p.listing_id IS NOT NULL AND p.scraped_at IS NOT NULL
+GROUP BY p.listing_id, w.width, date_trunc(w.width, p.scraped_at)
+ON CONFLICT DO NOTHING;
+-- +goose StatementEnd
+
+-- +goose Down
+-- +goose StatementBegin
+DROP TABLE IF EXISTS price_rollups;
+-- +goose StatementEnd
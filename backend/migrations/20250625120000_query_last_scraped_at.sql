@@ -0,0 +1,13 @@
+-- +goose Up
+-- +goose StatementBegin
+-- Set by the scrapers once a query has been scraped; the scheduler Lambda only
+-- sends queries whose frequency has elapsed since then.
+ALTER TABLE queries
+ADD COLUMN last_scraped_at TIMESTAMP;
+-- +goose StatementEnd
+
+-- +goose Down
+-- +goose StatementBegin
+ALTER TABLE queries
+DROP COLUMN last_scraped_at;
+-- +goose StatementEnd
@@ -78,6 +78,7 @@ class Queries(Base):
     query_text: Mapped[str] = mapped_column(Text)
     created_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime, server_default=text('CURRENT_TIMESTAMP'))
     removed_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
+    last_scraped_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
 
     client_queries: Mapped[List['ClientQueries']] = relationship('ClientQueries', back_populates='query')
     product_candidates: Mapped[List['ProductCandidates']] = relationship('ProductCandidates', back_populates='query')
@@ -161,6 +162,24 @@ class Prices(Base):
     listing: Mapped[Optional['Listings']] = relationship('Listings', back_populates='prices')
 
 
+class PriceRollups(Base):
+    __tablename__ = 'price_rollups'
+    __table_args__ = (
+        ForeignKeyConstraint(['listing_id'], ['listings.id'], ondelete='CASCADE', name='price_rollups_listing_id_fkey'),
+        PrimaryKeyConstraint('listing_id', 'bucket_width', 'bucket_start', name='price_rollups_pkey')
+    )
+
+    listing_id: Mapped[str] = mapped_column(Text, primary_key=True)
+    bucket_width: Mapped[str] = mapped_column(Text, primary_key=True)
+    bucket_start: Mapped[datetime.datetime] = mapped_column(DateTime, primary_key=True)
+    min_price: Mapped[Optional[decimal.Decimal]] = mapped_column(Numeric)
+    max_price: Mapped[Optional[decimal.Decimal]] = mapped_column(Numeric)
+    sum_price: Mapped[Optional[decimal.Decimal]] = mapped_column(Numeric)
+    price_count: Mapped[int] = mapped_column(Integer, server_default=text('0'))
+    last_price: Mapped[Optional[decimal.Decimal]] = mapped_column(Numeric)
+    last_scraped_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime)
+
+
 class ProductCandidates(Base):
     __tablename__ = 'product_candidates'
     __table_args__ = (
@@ -163,8 +163,17 @@ function App() {
       return;
     }
     try {
-      const response = await axiosClient.get(`/query/results?query_id=${queryId}`);
-      setResults(response.data);
+      // Results come in keyset pages: follow X-Next-Cursor until the last one
+      const allResults = [];
+      let cursor = null;
+      do {
+        const response = await axiosClient.get('/query/results', {
+          params: cursor ? { query_id: queryId, cursor } : { query_id: queryId }
+        });
+        allResults.push(...response.data);
+        cursor = response.headers['x-next-cursor'] || null;
+      } while (cursor);
+      setResults(allResults);
       setMessage('');
     } catch (error) {
       setMessage('❌ Error fetching results: ' + (error.response?.data?.detail || error.message));
@@ -546,7 +555,7 @@ function App() {
                                 <div className="col-4">
                                   <img 
                                     src={r.listings[0]?.img_url || 'https://via.placeholder.com/120x120?text=Sin+Imagen'} 
-                                    alt={r.title || r.id} 
+                                    alt={r.name || r.id} 
                                     style={{ 
                                       width: '100%',
                                       height: '120px',
@@ -565,7 +574,7 @@ function App() {
                                       WebkitLineClamp: 2,
                                       WebkitBoxOrient: 'vertical'
                                     }}>
-                                      🛍️ {r.title || `Producto ${r.id}`}
+                                      🛍️ {r.name || `Producto ${r.id}`}
                                     </h6>
                                   </div>
                                   <div className="small text-muted mb-2">
@@ -0,0 +1,96 @@
+"""
+Cold-start guard for the scheduler Lambda. Imports main.py in fresh
+interpreters (what a Lambda init does) and reports the import + init time,
+excluding interpreter startup. Fails when the median exceeds --budget or when
+a heavy module is loaded, so a stray import shows up before it is deployed.
+
+    python benchmarks/startup_benchmark.py --runs 5 --budget 0.8
+    python benchmarks/startup_benchmark.py --importtime   # slowest imports of one run
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules the scheduler must not pull in
+HEAVY_MODULES = ["sentence_transformers", "torch", "transformers", "numpy", "pandas", "pgvector"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "modules": sorted(m for m in sys.modules if "." not in m)}))
+"""
+
+
+def probe_env() -> dict:
+    # Region and URLs only need to be set, nothing is contacted while importing
+    return {
+        **os.environ,
+        "SQS_REGION": os.getenv("SQS_REGION", "us-east-1"),
+        "SQS_QUEUE_URL": os.getenv("SQS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/000000000000/benchmark.fifo"),
+    }
+
+
+def measure() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=LAMBDA_DIR, env=probe_env(),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(limit: int = 15) -> list:
+    """
+    Cumulative -X importtime of the modules main.py imports directly, slowest first.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"], cwd=LAMBDA_DIR, env=probe_env(),
+        capture_output=True, text=True, check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two more spaces per level, main's own are one level down
+        if name.startswith("   ") and not name.startswith("     "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("LAMBDA_STARTUP_BUDGET", "0.8")),
+                        help="maximum median import + init seconds")
+    parser.add_argument("--importtime", action="store_true", help="also list the slowest imports of main.py")
+    args = parser.parse_args()
+
+    runs = [measure() for _ in range(args.runs)]
+    seconds = [run["seconds"] for run in runs]
+    median = statistics.median(seconds)
+    print(f"import + init: median {median:.3f}s, min {min(seconds):.3f}s, max {max(seconds):.3f}s ({args.runs} runs)")
+
+    if args.importtime:
+        for cumulative, name in slowest_imports():
+            print(f"{cumulative / 1e6:>8.3f}s  {name}")
+
+    failures = []
+    heavy = [m for m in HEAVY_MODULES if m in runs[0]["modules"]]
+    if heavy:
+        failures.append(f"heavy modules imported: {', '.join(heavy)}")
+    if median > args.budget:
+        failures.append(f"median {median:.3f}s is over the {args.budget:.3f}s budget")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,15 @@
 import os
+import datetime
+import hashlib
 import json
 import logging
 import boto3
 from botocore.config import Config
-from database import Database
-from models import ClientQueries
-from sentence_transformers import SentenceTransformer
+from sqlalchemy import create_engine, text
+
+# Scheduler entry point: it only reads client_queries and sends SQS messages, so it
+# imports neither the models (pgvector/numpy) nor sentence_transformers, and it does
+# not bootstrap the schema (the backend's bootstrap.py owns that).
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("scraper")
@@ -18,44 +22,143 @@ sqs = boto3.client(
 )
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")  # or hardcode it here
 
-# Initialize global objects (if needed)
-db = Database()
-model = SentenceTransformer('all-MiniLM-L6-v2')  # if needed elsewhere
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+psycopg2://postgres:secret@db:5432/postgres")
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+psycopg2://")
+
+# No connection is opened until the first invocation; warm invocations reuse it
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, pool_size=1, max_overflow=0)
+
+# Queries are packed into one message until their pages add up to this
+# (a query with more pages gets a message of its own)
+MESSAGE_MAX_PAGES = int(os.getenv("MESSAGE_MAX_PAGES", "10"))
+# Queries with more pages are split into [first_page, end_page) shards of this many
+# pages, each sent on its own so several scraper tasks work on one deep query
+SHARD_PAGES = int(os.getenv("SHARD_PAGES", str(MESSAGE_MAX_PAGES)))
+# A query whose next run is due within this many minutes is sent anyway, so a
+# scrape that finished late in the previous slot does not push it a full slot back
+SCHEDULE_SLACK_MINUTES = int(os.getenv("SCHEDULE_SLACK_MINUTES", "10"))
+# SQS hard limit for SendMessageBatch
+SQS_MAX_BATCH = 10
+
+# Active queries whose most frequent subscription has elapsed since the last
+# scrape, with the largest pages_to_scrape any active client asked for
+DUE_QUERIES = text("""
+    SELECT q.id, q.query_text, max(cq.pages_to_scrape) AS pages_to_scrape
+    FROM client_queries cq
+    INNER JOIN queries q ON q.id = cq.query_id
+    WHERE cq.removed_at IS NULL
+      AND q.removed_at IS NULL
+    GROUP BY q.id, q.query_text, q.last_scraped_at
+    HAVING q.last_scraped_at IS NULL
+        OR q.last_scraped_at <= LOCALTIMESTAMP + make_interval(mins => :slack_minutes) - min(
+            CASE cq.frequency
+                WHEN 'hourly' THEN interval '1 hour'
+                WHEN 'daily' THEN interval '1 day'
+                WHEN 'weekly' THEN interval '1 week'
+                ELSE interval '1 month'
+            END
+        )
+    ORDER BY q.id
+""")
+
+
+def due_queries(connection) -> dict:
+    rows = connection.execute(DUE_QUERIES, {"slack_minutes": SCHEDULE_SLACK_MINUTES})
+    return {row.query_text: row.pages_to_scrape or 1 for row in rows}
+
+
+def shard_queries(queries: dict, shard_pages: int = SHARD_PAGES) -> list:
+    """
+    (query_text, work, pages) units: `work` is the page count of a query, or a
+    [first_page, end_page) range for the shards of a query deeper than `shard_pages`.
+    """
+    units = []
+    for query_text, pages in queries.items():
+        if pages <= shard_pages:
+            units.append((query_text, pages, pages))
+            continue
+        for first_page in range(0, pages, shard_pages):
+            end_page = min(first_page + shard_pages, pages)
+            units.append((query_text, [first_page, end_page], end_page - first_page))
+    return units
+
+
+def pack_messages(queries: dict, max_pages: int = MESSAGE_MAX_PAGES, shard_pages: int = SHARD_PAGES) -> list:
+    """
+    Groups queries (or their shards) into message bodies of at most `max_pages`
+    pages in the {"queries": {query_text: pages or [first_page, end_page]}}
+    format read by the scraper.
+    """
+    messages = []
+    current, pages = {}, 0
+    for query_text, work, unit_pages in sorted(shard_queries(queries, shard_pages), key=lambda unit: unit[2], reverse=True):
+        # Two shards of one query can not share a message (same key)
+        if current and (pages + unit_pages > max_pages or query_text in current):
+            messages.append(current)
+            current, pages = {}, 0
+        current[query_text] = work
+        pages += unit_pages
+    if current:
+        messages.append(current)
+    return messages
+
+
+def message_entries(messages: list, schedule_id: str) -> list:
+    """
+    SendMessageBatch entries. The group id follows the queries and page ranges
+    (the same work is never scraped twice at once, different messages and the
+    shards of one query run in parallel) and the dedup id also includes the
+    schedule event, so a retried invocation sends nothing new.
+    """
+    entries = []
+    for i, queries in enumerate(messages):
+        body = json.dumps({"queries": queries}, sort_keys=True)
+        group = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        entries.append({
+            "Id": str(i),
+            "MessageBody": body,
+            "MessageGroupId": group,
+            "MessageDeduplicationId": hashlib.sha1(f"{schedule_id}:{body}".encode("utf-8")).hexdigest(),
+        })
+    return entries
+
+
+def send_messages(entries: list) -> list:
+    """
+    Sends the entries in batches of 10 and returns the ones that failed.
+    """
+    failed = []
+    for start in range(0, len(entries), SQS_MAX_BATCH):
+        batch = entries[start:start + SQS_MAX_BATCH]
+        response = sqs.send_message_batch(QueueUrl=SQS_QUEUE_URL, Entries=batch)
+        by_id = {entry["Id"]: entry for entry in batch}
+        for failure in response.get("Failed", []):
+            logger.error("SQS message %s was not sent: %s", failure.get("Id"), failure.get("Message"))
+            failed.append(by_id[failure["Id"]])
+    return failed
+
 
 def lambda_handler(event, context):
     try:
-        # Query the database for ClientQueries
-        products = db.session.query(ClientQueries).all()
-        queries = {}
-        for product in products:
-            query_text = product.query.query_text
-            pages = product.pages_to_scrape
-            if query_text in queries:
-                if pages > queries[query_text]:
-                    queries[query_text] = pages
-            else:
-                queries[query_text] = pages
-
-        logger.info("Found queries: %s", queries)
-
-        # For each unique query, send an SQS message
-        for query_text, pages in queries.items():
-            message_body = json.dumps({
-                "query": query_text,
-                "pages_to_scrape": pages
-            })
-            response = sqs.send_message(
-                QueueUrl=SQS_QUEUE_URL,
-                MessageBody=message_body,
-                MessageGroupId="default"  # required for FIFO queues
-            )
-            logger.info("SQS message sent for query '%s': %s", query_text, response.get("MessageId"))
+        with engine.connect() as connection:
+            queries = due_queries(connection)
+
+        logger.info("Due queries: %s", queries)
+
+        messages = pack_messages(queries)
+        # EventBridge events carry an id that is reused when the invocation is retried
+        schedule_id = (event or {}).get("id") or datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M")
+        failed = send_messages(message_entries(messages, schedule_id))
+        logger.info("Sent %d queries in %d messages (%d failed)", len(queries), len(messages), len(failed))
 
         return {
-            "statusCode": 200,
+            "statusCode": 500 if failed else 200,
             "body": json.dumps({
-                "message": "SQS messages sent successfully",
-                "queries": queries
+                "message": "SQS messages sent successfully" if not failed else "Some SQS messages were not sent",
+                "queries": queries,
+                "messages": len(messages),
+                "failed": [json.loads(entry["MessageBody"])["queries"] for entry in failed]
             })
         }
     except Exception as e:
@@ -65,4 +168,4 @@ def lambda_handler(event, context):
             "body": json.dumps({
                 "error": str(e)
             })
-        }
\ No newline at end of file
+        }
@@ -1,66 +1,309 @@
 import asyncio
+import math
+from collections import deque
+from contextlib import aclosing
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 from .bases import RequestsManager
+from .extractors import ListingExtractor, ListingRecord, extract_records, get_extractor
+from .page_cache import PageCache
 from tqdm import tqdm
 import pandas as pd
+import logging
+
+logger = logging.getLogger("mercadolibre")
+
+QUERY_SEPARATOR = "-QUERYSEP-"
+COLUMNS = ["ml_id", "title", "price", "url", "img_url", "query"]
+PAGE_SIZE = 50
+# DataFrame.attrs key holding the {url: CacheEntry} fingerprints of the pages in a batch
+PAGE_FINGERPRINTS = "page_fingerprints"
+
+class PageInfo(NamedTuple):
+    """
+    What a fetched page tells about pagination. `ml_ids` is None when the page
+    body was not available (failed request or 304 from the page cache).
+    """
+    total: int
+    ml_ids: frozenset
+
+def merge_records(records) -> dict:
+    """
+    Merges records by ml_id keeping the first title/price/url/img_url and
+    collecting every query the listing showed up in.
+    """
+    merged = {}
+    for record in records:
+        current = merged.get(record["ml_id"])
+        if current is None:
+            merged[record["ml_id"]] = {**record, "query": {record["query"]}}
+        else:
+            current["query"].add(record["query"])
+    return merged
+
+def records_to_frame(merged:dict) -> pd.DataFrame:
+    """
+    Builds the scrape DataFrame (one row per ml_id, queries joined with -QUERYSEP-).
+    """
+    rows = [
+        {**record, "query": QUERY_SEPARATOR.join(record["query"])}
+        for _, record in sorted(merged.items())
+    ]
+    return pd.DataFrame(rows, columns=COLUMNS)
+
 class MercadoLibre(RequestsManager):
     """
     Mercado Libre API client
+
+    `queries` maps each query text to the number of pages to scrape, or to a
+    [first_page, end_page) page range (zero based) when the query is one shard
+    of a larger scrape split across workers.
     """
 
-    def __init__(self, headers=None, queries = {}, session = None, requests_per_minute=1000, requires_proxies=False):
-        super().__init__(headers, queries, session, requests_per_minute, requires_proxies)
-        
+    def __init__(self, headers=None, queries = {}, session = None, requests_per_minute=1000, requires_proxies=False, extractor=None, parse_workers=0, executor:ProcessPoolExecutor=None, page_cache:PageCache=None, adaptive_pagination=False, **kwargs):
+        super().__init__(headers, queries, session, requests_per_minute, requires_proxies=requires_proxies, **kwargs)
+        # Backend name ("soup", "lxml", "selectolax", "auto") or a ListingExtractor instance
+        self.extractor:ListingExtractor = extractor if isinstance(extractor, ListingExtractor) else get_extractor(extractor)
+        # Pages are parsed in a process pool instead of on the event loop when a
+        # shared executor is given or parse_workers > 0 (pool owned by this instance)
+        self.parse_workers = parse_workers
+        self.executor:ProcessPoolExecutor = executor
+        self.owns_executor = False
+        # Optional fingerprint cache (usually shared across runs): pages that answer
+        # 304 or whose listing set did not change yield no records
+        self.page_cache = page_cache
+        # Fingerprints of the pages yielded since the last batch, saved by the
+        # caller once that batch is in the database
+        self.unsaved_fingerprints = {}
+        # Fetch page 1 of each query first and only schedule the pages that exist
+        self.adaptive_pagination = adaptive_pagination
+
         self.base_url = "https://listado.mercadolibre.com.ar/"
         self.from_url = "Desde_"
         self.url_end = "_NoIndex_True"
-        
-    async def perform_scrape(self):
+
+    def page_offsets(self, value) -> list:
+        """
+        Result offsets to scrape for a query asking for `value` pages, or for
+        the pages of a [first_page, end_page) range.
+        """
+        first_page, end_page = value if isinstance(value, (list, tuple)) else (0, value)
+        return list(range(first_page*PAGE_SIZE, end_page*PAGE_SIZE, PAGE_SIZE))
+
+    def page_url(self, key, offset:int) -> str:
+        return self.base_url + key + self.from_url + str(offset) + self.url_end
+
+    def page_urls(self):
+        """
+        Yields (url, query) for every results page to scrape.
+        """
         for key,value in self.queries.items():
-            for i in range(0,value*50,50):
-                url = self.base_url + key + self.from_url + str(i) + self.url_end
-                task = asyncio.create_task(self.fetch_html(url,extra_data=key))
-                self.tasks.append(task)
-        results = []
-        for result in tqdm(asyncio.as_completed(self.tasks), total=len(self.tasks)):
-            soup,key = await result
-            
-            #soup = BeautifulSoup(res.text, 'html.parser')
-            for li in soup.find_all("li", {"class": "ui-search-layout__item"}):
-                url = li.find("a").attrs["href"].split("#")[0]
-                
-                img_url = li.find("div",{"class": "poly-card__portada"}).find("img").attrs["src"]
-                if "data" in img_url:
-                    img_url = li.find("div",{"class": "poly-card__portada"}).find("img").attrs["data-src"]
-                if "mclics" in url: #ads that are not from the search
-                    continue
-                if "/p/" in url:
-                    ml_id = url.split("/p/")[-1]
-                else:
-                    ml_id = url.split("/")[3]
-                    ml_id = ml_id.split("-")
-                    ml_id = "".join(ml_id[0:2])
-                title = li.find("a").text
-                price = li.find("span", {"class": "andes-money-amount__fraction"} ).text.replace(".","")
-                price = float(price.replace(",", "."))
-                results.append({
-                    "title": title,
-                    "price": price,
-                    "ml_id": ml_id,
-                    "url": url,
-                    "query": key,
-                    "img_url": img_url
-                })
-        self.data = pd.DataFrame(results)
-        self.data = (
-            self.data.groupby("ml_id", as_index=False)
-            .agg({
-                "title": "first",  # Keep the first title
-                "price": "first",  # Keep the first price
-                "url": "first",    # Keep the first URL
-                "img_url": "first",  # Keep the first image URL
-                "query": lambda x: "-QUERYSEP-".join(set(x))  # Combine queries into a single string
-            })
+            for offset in self.page_offsets(value):
+                yield self.page_url(key, offset), key
+
+    def parse_listings(self, html:str, key) -> list:
+        """
+        Extracts the listing records of a search results page.
+        """
+        return [
+            {**record._asdict(), "query": key}
+            for record in self.extractor.extract(html)
+        ]
+
+    async def parse_listings_in_pool(self, html:str, key) -> list:
+        """
+        Same as parse_listings but the parsing runs in the worker process pool.
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+            self.owns_executor = True
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(self.executor, extract_records, html, self.extractor.name)
+        return [
+            {**ListingRecord._make(row)._asdict(), "query": key}
+            for row in rows
+        ]
+
+    async def parse_page(self, html:str, key) -> list:
+        if (self.executor is not None or self.parse_workers > 0) and html:
+            return await self.parse_listings_in_pool(html, key)
+        return self.parse_listings(html, key)
+
+    async def fetch_page(self, url:str, key):
+        """
+        Fetches and parses one results page.
+        Returns (records, PageInfo, fingerprint), fingerprint being the page
+        cache entry to save once the records are loaded (None if nothing to save).
+        """
+        if self.page_cache is None:
+            html, key = await self.fetch_html(url,extra_data=key,parse=False)
+            records = await self.parse_page(html, key)
+            return records, self.page_info(html, records), None
+
+        result, key = await self.fetch_html(
+            url,
+            extra_data=key,
+            parse=False,
+            extra_headers=self.page_cache.conditional_headers(url),
+            return_meta=True
         )
-        self.data.reset_index(drop=True, inplace=True)
+        if result is None:
+            return [], PageInfo(None, None), None
+        html, meta = result
+        if meta["status"] == 304:
+            self.page_cache.record_not_modified(url)
+            return [], PageInfo(None, None), None
+        records = await self.parse_page(html, key)
+        info = self.page_info(html, records)
+        fingerprint = self.page_cache.check(url, records, meta["etag"], meta["last_modified"], meta["size"])
+        if fingerprint is None:
+            return [], info, None
+        return records, info, fingerprint
+
+    def page_info(self, html:str, records:list) -> PageInfo:
+        if html is None:
+            return PageInfo(None, None)
+        return PageInfo(self.extractor.extract_total(html), frozenset(r["ml_id"] for r in records))
+
+    async def iter_pages(self, max_in_flight:int = 20):
+        """
+        Async generator yielding the records of each page as soon as it is parsed.
+        At most `max_in_flight` pages are being fetched or parsed at any time.
+
+        With adaptive pagination only the first page of every query (or of its
+        page range) is scheduled up front. Its result count bounds the follow-up pages, which are then
+        fetched concurrently. A page that comes back empty, or only repeats
+        listings already seen for the query, marks the end of that query and
+        pages past it are dropped.
+        """
+        jobs = deque()
+        for key, value in self.queries.items():
+            offsets = self.page_offsets(value)
+            if self.adaptive_pagination:
+                offsets = offsets[:1]
+            jobs.extend((key, offset) for offset in offsets)
+        end_offsets = {}
+        seen = {key: set() for key in self.queries}
+        in_flight = {}
+
+        def past_end(key, offset):
+            return offset >= end_offsets.get(key, math.inf)
+
+        def schedule():
+            while jobs and len(in_flight) < max_in_flight:
+                key, offset = jobs.popleft()
+                if past_end(key, offset):
+                    progress.update(1)
+                    continue
+                url = self.page_url(key, offset)
+                task = asyncio.create_task(self.fetch_page(url, key))
+                in_flight[task] = (key, offset, url)
+
+        with tqdm(total=len(jobs)) as progress:
+            try:
+                schedule()
+                while in_flight:
+                    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        key, offset, url = in_flight.pop(task)
+                        progress.update(1)
+                        records, info, fingerprint = task.result()
+                        if self.adaptive_pagination:
+                            offsets = self.page_offsets(self.queries[key])
+                            if offset == offsets[0]:
+                                follow_ups = [
+                                    (key, o) for o in offsets[1:]
+                                    if info.total is None or o < info.total
+                                ]
+                                jobs.extend(follow_ups)
+                                progress.total += len(follow_ups)
+                                progress.refresh()
+                            if past_end(key, offset):
+                                continue
+                            if info.ml_ids is not None:
+                                if not info.ml_ids or info.ml_ids <= seen[key]:
+                                    end_offsets[key] = min(end_offsets.get(key, math.inf), offset)
+                                    continue
+                                seen[key].update(info.ml_ids)
+                        schedule()
+                        if fingerprint is not None:
+                            self.unsaved_fingerprints[url] = fingerprint
+                        yield records
+                    schedule()
+            finally:
+                # Closed early (consumer stopped or an exception): don't leave
+                # page fetches running against a session that is about to close.
+                for task in in_flight:
+                    task.cancel()
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def iter_batches(self, batch_size:int = 500, max_in_flight:int = 20):
+        """
+        Async generator yielding DataFrames of at least `batch_size` listings
+        (the last one may be smaller) while pages are still being fetched.
+        A listing is emitted once per run with every query it was found by so
+        far. If it shows up again under a new query after its batch was yielded,
+        it is emitted again with only the new queries and price=None, so the
+        query gets its candidate without a second price for this run.
+        With a page cache, each frame carries in attrs[PAGE_FINGERPRINTS] the
+        fingerprints to save (PageCache.save) after the batch is loaded.
+        """
+        emitted = {}
+        buffer = []
+        async with aclosing(self.iter_pages(max_in_flight=max_in_flight)) as pages:
+            async for records in pages:
+                buffer.extend(record for record in records if record["query"] not in emitted.get(record["ml_id"], ()))
+                if len(buffer) >= batch_size:
+                    yield self.batch_frame(buffer, emitted)
+                    buffer = []
+        if buffer:
+            yield self.batch_frame(buffer, emitted)
+        logger.info(f"Rate limiter stats: {self.rate_limiter.stats()}")
+
+    def batch_frame(self, records:list, emitted:dict) -> pd.DataFrame:
+        df = records_to_frame(self.merge_new(records, emitted))
+        df.attrs[PAGE_FINGERPRINTS], self.unsaved_fingerprints = self.unsaved_fingerprints, {}
+        return df
+
+    def merge_new(self, records:list, emitted:dict) -> dict:
+        """
+        Merges a batch of records and records the (ml_id, query) pairs in
+        `emitted`. Listings already emitted in an earlier batch lose their price.
+        """
+        merged = merge_records(records)
+        for ml_id, record in merged.items():
+            if ml_id in emitted:
+                record["price"] = None
+            emitted.setdefault(ml_id, set()).update(record["query"])
+        return merged
+
+    async def perform_scrape(self, max_in_flight:int = 20):
+        records = []
+        async with aclosing(self.iter_pages(max_in_flight=max_in_flight)) as pages:
+            async for page in pages:
+                records.extend(page)
+        self.data = records_to_frame(merge_records(records))
+        self.data.attrs[PAGE_FINGERPRINTS], self.unsaved_fingerprints = self.unsaved_fingerprints, {}
+        logger.info(f"Rate limiter stats: {self.rate_limiter.stats()}")
         return self.data
 
+    def shutdown_parse_pool(self):
+        """
+        Shuts down the parse process pool if this instance created it, waiting
+        for its worker processes to exit. Parses not started yet are cancelled.
+        """
+        if self.owns_executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+            self.owns_executor = False
+
+    async def close(self):
+        """
+        Shuts down the parse process pool and closes the aiohttp session.
+        """
+        # Waiting for the workers to exit blocks, keep it off the event loop
+        await asyncio.to_thread(self.shutdown_parse_pool)
+        logger.info(f"Connection stats: {self.connections.connection_stats()}")
+        if self.page_cache is not None:
+            logger.info(f"Page cache stats: {self.page_cache.cache_stats()}")
+        await super().close()
@@ -0,0 +1,83 @@
+import asyncio
+import random
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second up to `burst` tokens.
+    """
+    def __init__(self, rate:float, burst:int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """
+        Waits until a token is available and takes it.
+        """
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    Per-host token buckets with an optional random jitter.
+    Callers wait here before taking a concurrency slot, so waiting never
+    holds a connection slot and the concurrency limit stays independent.
+    """
+    def __init__(self, requests_per_minute:float = 1000, burst:int = None, jitter:tuple = (0, 0)):
+        self.rate = requests_per_minute / 60
+        self.burst = burst if burst else max(1, int(self.rate))
+        self.jitter = jitter
+        self.buckets = {}
+        self.started_at = None
+        self.granted = 0
+        self.completed = 0
+
+    def bucket_for(self, url:str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    async def acquire(self, url:str):
+        """
+        Applies the jitter policy and then waits for a token of the url's host.
+        """
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+        low, high = self.jitter
+        if high > 0:
+            await asyncio.sleep(random.uniform(low, high))
+        await self.bucket_for(url).acquire()
+        self.granted += 1
+
+    def record_completion(self):
+        self.completed += 1
+
+    def stats(self) -> dict:
+        """
+        Target vs achieved requests per second since the first acquire.
+        """
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            "target_rps": round(self.rate, 2),
+            "achieved_rps": round(self.completed / elapsed, 2) if elapsed else 0.0,
+            "granted_rps": round(self.granted / elapsed, 2) if elapsed else 0.0,
+            "requests": self.completed,
+            "hosts": len(self.buckets),
+            "elapsed": round(elapsed, 2),
+        }
@@ -0,0 +1,91 @@
+"""
+Measure pages/sec per core of every installed HTML extractor over saved
+search result pages, and check that they all produce the same records.
+
+By default it runs over the result pages committed in benchmarks/fixtures,
+so numbers are comparable between runs and machines:
+
+    python benchmarks/parse_benchmark.py --repeat 20
+
+The committed pages follow the markup the extractors target (poly-card
+items, ads, catalog links, lazy loaded images, inline state). To benchmark
+against live pages instead, download them into another directory:
+
+    python benchmarks/parse_benchmark.py --fixtures /tmp/live --fetch "iphone" --pages 5
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from base.bases import load_user_agents
+from base.extractors import EXTRACTORS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+BASE_URL = "https://listado.mercadolibre.com.ar/{query}Desde_{offset}_NoIndex_True"
+
+
+def fetch_fixtures(query: str, pages: int, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    headers = {"User-Agent": load_user_agents()[0]}
+    for page in range(pages):
+        url = BASE_URL.format(query=query, offset=page * 50)
+        response = requests.get(url, headers=headers, timeout=30)
+        response.raise_for_status()
+        path = os.path.join(directory, f"{query.replace(' ', '-')}-{page}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(response.text)
+        print(f"saved {path}")
+
+
+def load_fixtures(directory: str) -> list:
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            pages.append(f.read())
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="directory with saved *.html result pages")
+    parser.add_argument("--repeat", type=int, default=10, help="passes over the fixture set per backend")
+    parser.add_argument("--fetch", metavar="QUERY", help="download result pages for QUERY into the fixtures directory")
+    parser.add_argument("--pages", type=int, default=3, help="pages to download with --fetch")
+    args = parser.parse_args()
+
+    if args.fetch:
+        fetch_fixtures(args.fetch, args.pages, args.fixtures)
+
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        parser.error(f"no fixture pages in {args.fixtures}, use --fetch QUERY to download some")
+
+    reference = None
+    print(f"{len(pages)} pages x {args.repeat} passes")
+    print(f"{'backend':<12} {'pages/s':>10} {'records':>8} {'same':>6}")
+    for name, extractor_cls in EXTRACTORS.items():
+        try:
+            extractor = extractor_cls()
+        except ImportError as e:
+            print(f"{name:<12} skipped ({e})")
+            continue
+        records = [extractor.extract(page) for page in pages]
+        if reference is None:
+            reference = records
+        start = time.process_time()
+        for _ in range(args.repeat):
+            for page in pages:
+                extractor.extract(page)
+        elapsed = time.process_time() - start
+        total = sum(len(r) for r in records)
+        print(f"{name:<12} {len(pages) * args.repeat / elapsed:>10.1f} {total:>8} {str(records == reference):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Run SQSConsumer against an in-memory stand-in queue and report messages/minute.
+
+Each message is handled by a fake scrape that sleeps for a random duration, so
+the numbers show how consumer settings (batch size, workers) affect throughput
+without AWS, a database or network access:
+
+    python benchmarks/sqs_harness.py --messages 50 --workers 1 --batch-size 1
+    python benchmarks/sqs_harness.py --messages 50 --workers 8
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consumer import SQSConsumer
+
+
+class InMemoryQueue:
+    """
+    Minimal SQS stand-in implementing the client calls used by SQSConsumer,
+    including visibility timeouts and redelivery of unacknowledged messages.
+    """
+
+    def __init__(self, visibility_timeout: float = 30):
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.invisible_until = {}
+        self.receipts = {}
+        self.receive_counts = collections.Counter()
+        self.calls = {"receive_message": 0, "delete_message_batch": 0, "change_message_visibility": 0}
+        self._ids = itertools.count()
+        # The consumer calls the client from worker threads
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self.lock:
+            message_id = str(next(self._ids))
+            self.messages[message_id] = MessageBody
+        return {"MessageId": message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None,
+                        MessageSystemAttributeNames=()):
+        timeout = VisibilityTimeout if VisibilityTimeout is not None else self.visibility_timeout
+        batch = []
+        with self.lock:
+            self.calls["receive_message"] += 1
+            now = time.monotonic()
+            for message_id, body in self.messages.items():
+                if len(batch) >= MaxNumberOfMessages:
+                    break
+                if self.invisible_until.get(message_id, 0) > now:
+                    continue
+                receipt = uuid.uuid4().hex
+                self.receipts[receipt] = message_id
+                self.invisible_until[message_id] = now + timeout
+                self.receive_counts[message_id] += 1
+                attributes = {"ApproximateReceiveCount": str(self.receive_counts[message_id])}
+                batch.append({"MessageId": message_id, "ReceiptHandle": receipt, "Body": body, "Attributes": attributes})
+        return {"Messages": batch} if batch else {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self.lock:
+            self.calls["change_message_visibility"] += 1
+            self.invisible_until[self.receipts[ReceiptHandle]] = time.monotonic() + VisibilityTimeout
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful = []
+        with self.lock:
+            self.calls["delete_message_batch"] += 1
+            for entry in Entries:
+                message_id = self.receipts.pop(entry["ReceiptHandle"], None)
+                if message_id is not None:
+                    self.messages.pop(message_id, None)
+                    self.invisible_until.pop(message_id, None)
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": []}
+
+
+def fake_scrape(min_seconds: float, max_seconds: float):
+    async def handle(body):
+        await asyncio.sleep(random.uniform(min_seconds, max_seconds))
+    return handle
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="shortest fake scrape")
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="longest fake scrape")
+    parser.add_argument("--visibility-timeout", type=float, default=0.5,
+                        help="short on purpose so heartbeats are exercised")
+    args = parser.parse_args()
+
+    queue = InMemoryQueue()
+    for i in range(args.messages):
+        queue.send_message(QueueUrl="local", MessageBody=f'{{"queries": {{"query-{i}": 1}}}}')
+
+    consumer = SQSConsumer(
+        queue,
+        "local",
+        fake_scrape(args.min_seconds, args.max_seconds),
+        max_workers=args.workers,
+        batch_size=args.batch_size,
+        wait_time=0,
+        visibility_timeout=args.visibility_timeout,
+        heartbeat_interval=args.visibility_timeout / 3,
+    )
+    report = await consumer.run(idle_exit=True)
+    print(f"workers={args.workers} batch_size={args.batch_size}")
+    for key, value in {**report, **queue.calls, "left_in_queue": len(queue.messages)}.items():
+        print(f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("consumer")
+
+# SQS hard limit for ReceiveMessage and DeleteMessageBatch
+SQS_MAX_BATCH = 10
+# Deletes of a message tried before giving up (it is then redelivered), and the
+# first retry delay in seconds, doubled on every attempt
+ACK_MAX_ATTEMPTS = 4
+ACK_RETRY_BACKOFF = 1.0
+
+
+class SQSConsumer:
+    """
+    Receives up to 10 messages per poll and processes them concurrently with at
+    most `max_workers` handlers running. While a handler runs, its message
+    visibility is extended every `heartbeat_interval` seconds. Messages whose
+    handler returned without raising are acknowledged with delete_message_batch,
+    once 10 are pending, the oldest has waited `ack_delay` seconds (by default a
+    third of the visibility timeout, at most 10 s) or the queue is idle. Messages
+    Deletes that fail are retried with exponential backoff. Messages
+    whose handler raised are left on the queue and come back after the timeout,
+    until the queue's redrive policy moves them to its dead-letter queue.
+    boto3 calls are blocking, so they run in the default thread pool and a 20 s
+    long poll does not stall the handlers sharing the event loop.
+    """
+
+    def __init__(self, client, queue_url: str, handler, max_workers: int = 4, batch_size: int = SQS_MAX_BATCH,
+                 wait_time: int = 20, visibility_timeout: int = 300, heartbeat_interval: float = 60,
+                 ack_delay: float = None):
+        self.client = client
+        self.queue_url = queue_url
+        self.handler = handler
+        self.max_workers = max_workers
+        self.batch_size = min(batch_size, SQS_MAX_BATCH)
+        self.wait_time = wait_time
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        # Must stay well below the visibility timeout or acknowledged work is redelivered
+        self.ack_delay = ack_delay if ack_delay is not None else min(10, visibility_timeout / 3)
+        self.slots = asyncio.Semaphore(max_workers)
+        self.in_flight = set()
+        self.pending_acks = []
+        self.oldest_ack_at = None
+        # Delete attempts per receipt handle and when the next retry is allowed
+        self.ack_attempts = {}
+        self.ack_retry_at = 0.0
+        self.stats = {"received": 0, "processed": 0, "failed": 0, "acked": 0, "ack_retries": 0, "extended": 0}
+        self.started_at = None
+
+    async def run(self, idle_exit: bool = False):
+        """
+        Polls forever. With idle_exit=True returns once the queue is empty and
+        every received message has been handled (used by the local harness).
+        """
+        self.started_at = time.monotonic()
+        while True:
+            if self.acks_due():
+                await self.flush_acks()
+            free = self.max_workers - len(self.in_flight)
+            if free <= 0:
+                await asyncio.wait(self.in_flight, timeout=self.ack_wait(), return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                response = await asyncio.to_thread(
+                    self.client.receive_message,
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=min(self.batch_size, free),
+                    WaitTimeSeconds=self.wait_time,  # Long polling
+                    VisibilityTimeout=self.visibility_timeout,
+                    MessageSystemAttributeNames=["ApproximateReceiveCount"],
+                )
+            except Exception as e:
+                logger.error(f"Error polling SQS: {e}")
+                await asyncio.sleep(5)  # Wait before retrying
+                continue
+
+            messages = response.get("Messages", [])
+            self.stats["received"] += len(messages)
+            for message in messages:
+                task = asyncio.create_task(self.process(message))
+                self.in_flight.add(task)
+                task.add_done_callback(self.in_flight.discard)
+
+            if not messages and idle_exit and not self.in_flight:
+                await self.drain_acks()
+                return self.report()
+            if not messages and self.in_flight:
+                # Nothing visible right now: wait for a handler instead of re-polling in a loop
+                ack_wait = self.ack_wait()
+                timeout = self.heartbeat_interval if ack_wait is None else min(self.heartbeat_interval, ack_wait)
+                await asyncio.wait(self.in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            if not messages:
+                # Idle queue: nothing else will fill the batch
+                await self.flush_acks()
+            # Give the new handlers a chance to start before polling again
+            await asyncio.sleep(0)
+
+    async def process(self, message: dict):
+        async with self.slots:
+            heartbeat = asyncio.create_task(self.keep_invisible(message["ReceiptHandle"]))
+            try:
+                await self.handler(message["Body"])
+            except Exception as e:
+                self.stats["failed"] += 1
+                receive_count = message.get("Attributes", {}).get("ApproximateReceiveCount", "?")
+                logger.error(f"Error handling message {message.get('MessageId')} (delivery {receive_count}): {e}")
+                return
+            finally:
+                heartbeat.cancel()
+            self.stats["processed"] += 1
+            if self.oldest_ack_at is None:
+                self.oldest_ack_at = time.monotonic()
+            self.pending_acks.append(message)
+            if len(self.pending_acks) >= SQS_MAX_BATCH:
+                await self.flush_acks()
+
+    async def keep_invisible(self, receipt_handle: str):
+        """
+        Extends the visibility timeout of a message while its scrape is still running.
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await asyncio.to_thread(
+                    self.client.change_message_visibility,
+                    QueueUrl=self.queue_url,
+                    ReceiptHandle=receipt_handle,
+                    VisibilityTimeout=self.visibility_timeout,
+                )
+                self.stats["extended"] += 1
+            except Exception as e:
+                logger.warning(f"Could not extend message visibility: {e}")
+
+    def acks_due(self) -> bool:
+        return bool(self.pending_acks) and time.monotonic() >= self.ack_retry_at and (
+            len(self.pending_acks) >= SQS_MAX_BATCH or time.monotonic() - self.oldest_ack_at >= self.ack_delay
+        )
+
+    def ack_wait(self):
+        """
+        Seconds until the pending acks are due (None when there are none).
+        """
+        if not self.pending_acks:
+            return None
+        now = time.monotonic()
+        return max(0, self.ack_delay - (now - self.oldest_ack_at), self.ack_retry_at - now)
+
+    async def flush_acks(self):
+        """
+        Deletes processed messages in batches of up to 10. A batch whose call
+        failed, and entries SQS could not delete, go back to the pending acks
+        and are retried once the backoff is over.
+        """
+        if time.monotonic() < self.ack_retry_at:
+            return
+        retry = []
+        while self.pending_acks:
+            batch, self.pending_acks = self.pending_acks[:SQS_MAX_BATCH], self.pending_acks[SQS_MAX_BATCH:]
+            entries = [
+                {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+                for i, message in enumerate(batch)
+            ]
+            try:
+                response = await asyncio.to_thread(
+                    self.client.delete_message_batch, QueueUrl=self.queue_url, Entries=entries
+                )
+            except Exception as e:
+                logger.error(f"Error deleting messages: {e}")
+                retry.extend(batch)
+                continue
+            for success in response.get("Successful", []):
+                self.ack_attempts.pop(batch[int(success["Id"])]["ReceiptHandle"], None)
+            self.stats["acked"] += len(response.get("Successful", []))
+            for failure in response.get("Failed", []):
+                logger.error(f"Could not delete message: {failure}")
+                # Sender faults (e.g. an expired receipt handle) fail the same way again
+                if not failure.get("SenderFault"):
+                    retry.append(batch[int(failure["Id"])])
+        self.oldest_ack_at = None
+        self.retry_acks(retry)
+
+    def retry_acks(self, messages: list):
+        """
+        Puts messages whose delete failed back in front of the pending acks and
+        delays the next flush, doubling the delay on every attempt.
+        """
+        attempts = 0
+        kept = []
+        for message in messages:
+            receipt_handle = message["ReceiptHandle"]
+            attempt = self.ack_attempts.get(receipt_handle, 0) + 1
+            if attempt >= ACK_MAX_ATTEMPTS:
+                self.ack_attempts.pop(receipt_handle, None)
+                logger.error(f"Giving up deleting message {message.get('MessageId')}, it will be redelivered")
+                continue
+            self.ack_attempts[receipt_handle] = attempt
+            attempts = max(attempts, attempt)
+            kept.append(message)
+        if not kept:
+            return
+        self.stats["ack_retries"] += len(kept)
+        self.pending_acks = kept + self.pending_acks
+        now = time.monotonic()
+        # Due as soon as the backoff is over
+        self.oldest_ack_at = now - self.ack_delay
+        self.ack_retry_at = now + ACK_RETRY_BACKOFF * 2 ** (attempts - 1)
+
+    async def drain_acks(self):
+        """
+        Flushes every pending ack, waiting out the retry backoff (used before exiting).
+        """
+        while self.pending_acks:
+            await asyncio.sleep(max(0, self.ack_retry_at - time.monotonic()))
+            await self.flush_acks()
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            **self.stats,
+            "elapsed": round(elapsed, 2),
+            "messages_per_minute": round(self.stats["processed"] * 60 / elapsed, 1) if elapsed else 0.0,
+        }
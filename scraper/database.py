@@ -6,6 +6,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sentence_transformers import SentenceTransformer
 from base.mercadolibre import MercadoLibre
+from matching import MATCH_EF_SEARCH, nearest_products
 from sqlalchemy import select
 from sqlalchemy.exc import PendingRollbackError
 import os
@@ -26,7 +27,9 @@ class Database:
         
         try:
             self.engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-            self.session = sessionmaker(bind=self.engine)()
+            # Factory for short lived sessions (one per unit of work / worker thread)
+            self.Session = sessionmaker(bind=self.engine)
+            self.session = self.Session()
             
             # Test the connection
             self.session.execute(text("SELECT 1"))
@@ -39,7 +42,8 @@ class Database:
             logger.error(f"❌ Database connection failed: {e}")
             # Initialize session anyway for health checks
             self.engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-            self.session = sessionmaker(bind=self.engine)()
+            self.Session = sessionmaker(bind=self.engine)
+            self.session = self.Session()
     def initialize_database(self):
         """
         Initialize database tables and basic data
@@ -125,27 +129,14 @@ class Database:
             logger.warning("Please ensure pgvector is installed in your PostgreSQL instance")
             # Don't raise the exception as the rest of the app might still work
             self.session.rollback()
-    def find_nearest_title(self,product):
-        # Encode the product title into a vector
+    def find_nearest_title(self,product, ef_search:int = MATCH_EF_SEARCH):
+        """
+        Nearest product (product_id, distance) of a single listing, None when there
+        are no products. Runs the prepared top-k statement of matching.nearest_products.
+        """
         query_vector = product["title_vector"]
-        query_vector = list(map(float, query_vector))  # Ensure it's a list of floats
-
-        # Convert the query vector into a PostgreSQL-compatible array and cast it to 'vector'
-        query_vector_str = ','.join(map(str, query_vector))
-
-        # Raw SQL query
-        raw_query = text(f"""
-                        SELECT 
-                            product_id, 
-                            embedding, 
-                            embedding <=> '[{query_vector_str}]'::vector AS distance  -- Using <=> for HNSW search
-                        FROM 
-                            product_embeddings
-                        ORDER BY 
-                            distance  -- Orders by closest match
-                        LIMIT 5;    -- Limits the results to the top 5 closest matches
-                    """)
-        return self.session.execute(raw_query).first()
+        nearest = nearest_products(self.session, query_vector, k=1, ef_search=ef_search)
+        return nearest[0] if nearest else None
     def find_listing_by_ml_id(self,product):
         return self.session.query(Listings).filter(Listings.external_id == product.ml_id , Listings.marketplace_id == 1).first()
     def retrieve_queries(self,queries:list[String]):
@@ -0,0 +1,315 @@
+import logging
+import os
+
+from sqlalchemy import literal_column, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import PendingRollbackError
+
+from models import Listings, Prices, ProductCandidates
+
+logger = logging.getLogger("ingest")
+
+# "bulk" writes listings, candidates and prices with set-based statements in a
+# single transaction. "orm" keeps the original per-row session.add_all path.
+INGEST_MODE = os.getenv("INGEST_MODE", "bulk")
+# Rows per multi-row INSERT statement
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "1000"))
+QUERY_SEPARATOR = "-QUERYSEP-"
+
+EXISTING_LISTINGS_QUERY = text("""
+    SELECT id, external_id, img_url
+    FROM listings
+    WHERE marketplace_id = :marketplace_id
+      AND external_id = ANY(:external_ids)
+""")
+
+# (listing, query) pairs that already have a candidate, so a listing found by a
+# new query gets one without duplicating the others
+EXISTING_CANDIDATES_QUERY = text("""
+    SELECT listing_id, query_id
+    FROM product_candidates
+    WHERE listing_id = ANY(:listing_ids)
+      AND query_id = ANY(:query_ids)
+""")
+
+# Merges freshly inserted prices into their hour/day/week buckets. Prices are
+# append-only, so existing aggregates are combined with the new ones instead of
+# being recomputed from the prices table.
+MERGE_PRICE_ROLLUPS = text("""
+    INSERT INTO price_rollups AS r (
+        listing_id, bucket_width, bucket_start, min_price, max_price,
+        sum_price, price_count, last_price, last_scraped_at
+    )
+    SELECT
+        np.listing_id,
+        w.width,
+        date_trunc(w.width, np.scraped_at),
+        min(np.price),
+        max(np.price),
+        sum(np.price),
+        count(np.price),
+        (array_agg(np.price ORDER BY np.scraped_at DESC))[1],
+        max(np.scraped_at)
+    FROM (
+        SELECT listing_id, price, COALESCE(scraped_at, LOCALTIMESTAMP) AS scraped_at
+        FROM unnest(
+            CAST(:listing_ids AS text[]),
+            CAST(:prices AS numeric[]),
+            CAST(:scraped_at AS timestamp[])
+        ) AS t(listing_id, price, scraped_at)
+    ) np
+    CROSS JOIN (VALUES ('hour'), ('day'), ('week')) AS w(width)
+    GROUP BY np.listing_id, w.width, date_trunc(w.width, np.scraped_at)
+    ON CONFLICT (listing_id, bucket_width, bucket_start) DO UPDATE SET
+        min_price = LEAST(r.min_price, EXCLUDED.min_price),
+        max_price = GREATEST(r.max_price, EXCLUDED.max_price),
+        sum_price = COALESCE(r.sum_price, 0) + COALESCE(EXCLUDED.sum_price, 0),
+        price_count = r.price_count + EXCLUDED.price_count,
+        last_price = CASE
+            WHEN r.last_scraped_at IS NULL OR EXCLUDED.last_scraped_at >= r.last_scraped_at THEN EXCLUDED.last_price
+            ELSE r.last_price
+        END,
+        last_scraped_at = GREATEST(r.last_scraped_at, EXCLUDED.last_scraped_at)
+""")
+
+# The scheduler Lambda compares this with the query frequency to decide what is due
+MARK_QUERIES_SCRAPED = text("""
+    UPDATE queries
+    SET last_scraped_at = LOCALTIMESTAMP
+    WHERE query_text = ANY(CAST(:query_texts AS text[]))
+""")
+
+
+def chunked(items: list, size: int = INGEST_CHUNK_SIZE):
+    """
+    Yield successive slices of `items` with at most `size` elements.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def has_price(price) -> bool:
+    """
+    False for rows that only carry new queries of a listing already priced in
+    this run (price None, or NaN once it went through a DataFrame).
+    """
+    return price is not None and price == price
+
+
+def safe_commit(session):
+    """
+    Safely commit the session, handling PendingRollbackError.
+    """
+    try:
+        session.commit()
+    except PendingRollbackError:
+        session.rollback()
+        raise Exception("Transaction failed and was rolled back.")
+
+
+def update_price_rollups(session, prices: list):
+    """
+    Adds (listing_id, price, scraped_at) tuples to the price_rollups buckets.
+    A None scraped_at means the row took its CURRENT_TIMESTAMP default.
+    Runs in the caller's transaction so rollups commit together with the prices.
+    """
+    for chunk in chunked(prices):
+        listing_ids, values, scraped_at = zip(*chunk)
+        session.execute(MERGE_PRICE_ROLLUPS, {
+            "listing_ids": list(listing_ids),
+            "prices": list(values),
+            "scraped_at": list(scraped_at),
+        })
+
+
+def mark_queries_scraped(session, query_texts: list):
+    """
+    Records that the queries were scraped so they are not scheduled again until
+    their frequency has elapsed.
+    """
+    if not query_texts:
+        return
+    session.execute(MARK_QUERIES_SCRAPED, {"query_texts": list(query_texts)})
+    safe_commit(session)
+
+
+def ingest(session, df, product_ids: list, distances: list, queries_map: dict, marketplace_id: int = 1, mode: str = INGEST_MODE):
+    """
+    Store the scraped rows of `df` as listings, product candidates and prices.
+    `product_ids` and `distances` are aligned with the rows of `df` and
+    `queries_map` maps query text to its Queries row.
+    """
+    if mode == "orm":
+        return ingest_orm(session, df, product_ids, distances, queries_map, marketplace_id)
+    return ingest_bulk(session, df, product_ids, distances, queries_map, marketplace_id)
+
+
+def ingest_orm(session, df, product_ids: list, distances: list, queries_map: dict, marketplace_id: int = 1):
+    """
+    Original ingest path: one lookup per listing and several ORM commits.
+    """
+    new_candidates = []
+    new_listings = []
+    all_listings = {}
+    safe_commit_flag = False
+    for prod, product_id, distance in zip(df.itertuples(index=False), product_ids, distances):
+        listing = session.query(Listings).filter(
+            Listings.external_id == prod.ml_id, Listings.marketplace_id == marketplace_id
+        ).first()
+        if not listing:
+            listing = Listings(
+                external_id=prod.ml_id,
+                title=prod.title,
+                url=prod.url,
+                marketplace_id=marketplace_id,
+                img_url=prod.img_url
+            )
+            new_listings.append(listing)
+            known_query_ids = set()
+        else:
+            known_query_ids = {
+                query_id for query_id, in session.query(ProductCandidates.query_id).filter(
+                    ProductCandidates.listing_id == listing.id
+                )
+            }
+            if listing.img_url != prod.img_url:
+                listing.img_url = prod.img_url
+                safe_commit_flag = True
+
+        for query_text in prod.query.split(QUERY_SEPARATOR):
+            if query_text not in queries_map or queries_map[query_text].id in known_query_ids:
+                continue
+            candidate = ProductCandidates(
+                query_id=queries_map[query_text].id,
+                product_id=product_id,
+                match_method='cosine',
+                distance=distance,
+                decided=False,
+                listing=listing
+            )
+            new_candidates.append(candidate)
+        if has_price(prod.price):
+            all_listings[prod] = listing
+    if new_listings:
+        session.add_all(new_listings)
+        safe_commit_flag = True
+    if safe_commit_flag:
+        safe_commit(session)
+
+    for candidate in new_candidates:
+        candidate.listing_id = candidate.listing.id
+    if new_candidates:
+        session.add_all(new_candidates)
+        safe_commit(session)
+
+    all_prices = [
+        Prices(listing_id=listing.id, price=float(prod.price))
+        for prod, listing in all_listings.items()
+    ]
+    session.add_all(all_prices)
+    update_price_rollups(session, [(price.listing_id, price.price, None) for price in all_prices])
+    safe_commit(session)
+    return len(all_prices)
+
+
+def ingest_bulk(session, df, product_ids: list, distances: list, queries_map: dict, marketplace_id: int = 1):
+    """
+    Set-based ingest path. Existing listings are pre-fetched with one ANY()
+    query, new or changed listings are upserted with ON CONFLICT ... RETURNING,
+    and candidates and prices are written with multi-row INSERTs. Everything
+    is committed in a single transaction.
+    """
+    # ON CONFLICT DO UPDATE cannot touch the same row twice in one statement
+    rows = {}
+    for prod, product_id, distance in zip(df.itertuples(index=False), product_ids, distances):
+        rows.setdefault(prod.ml_id, (prod, product_id, distance))
+    if not rows:
+        return 0
+
+    try:
+        existing = {
+            row.external_id: row
+            for row in session.execute(
+                EXISTING_LISTINGS_QUERY,
+                {"marketplace_id": marketplace_id, "external_ids": list(rows)}
+            )
+        }
+        listing_ids = {external_id: row.id for external_id, row in existing.items()}
+
+        to_upsert = [
+            {
+                "external_id": prod.ml_id,
+                "title": prod.title,
+                "url": prod.url,
+                "marketplace_id": marketplace_id,
+                "img_url": prod.img_url,
+            }
+            for prod, _, _ in rows.values()
+            if prod.ml_id not in existing or existing[prod.ml_id].img_url != prod.img_url
+        ]
+        created = set()
+        for chunk in chunked(to_upsert):
+            stmt = insert(Listings).values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                constraint="unique_marketplace_external",
+                set_={"img_url": stmt.excluded.img_url},
+            ).returning(
+                Listings.id,
+                Listings.external_id,
+                # xmax is 0 only for freshly inserted tuples
+                literal_column("(xmax = 0)").label("inserted"),
+            )
+            for listing in session.execute(stmt):
+                listing_ids[listing.external_id] = listing.id
+                if listing.inserted:
+                    created.add(listing.external_id)
+
+        query_ids = {
+            queries_map[query_text].id
+            for prod, _, _ in rows.values()
+            for query_text in prod.query.split(QUERY_SEPARATOR)
+            if query_text in queries_map
+        }
+        known_listing_ids = [listing_ids[ml_id] for ml_id in rows if ml_id not in created]
+        existing_candidates = {
+            (row.listing_id, row.query_id)
+            for row in session.execute(
+                EXISTING_CANDIDATES_QUERY,
+                {"listing_ids": known_listing_ids, "query_ids": list(query_ids)}
+            )
+        } if known_listing_ids and query_ids else set()
+        candidates = [
+            {
+                "query_id": queries_map[query_text].id,
+                "product_id": product_id,
+                "match_method": "cosine",
+                "distance": distance,
+                "decided": False,
+                "listing_id": listing_ids[prod.ml_id],
+            }
+            for prod, product_id, distance in rows.values()
+            for query_text in prod.query.split(QUERY_SEPARATOR)
+            if query_text in queries_map
+            and (listing_ids[prod.ml_id], queries_map[query_text].id) not in existing_candidates
+        ]
+        for chunk in chunked(candidates):
+            session.execute(insert(ProductCandidates).values(chunk))
+
+        prices = [
+            {"listing_id": listing_ids[prod.ml_id], "price": float(prod.price)}
+            for prod, _, _ in rows.values()
+            if has_price(prod.price)
+        ]
+        inserted_prices = []
+        for chunk in chunked(prices):
+            inserted_prices.extend(session.execute(
+                insert(Prices).values(chunk).returning(Prices.listing_id, Prices.price, Prices.scraped_at)
+            ))
+        update_price_rollups(session, [tuple(row) for row in inserted_prices])
+
+        safe_commit(session)
+    except Exception:
+        session.rollback()
+        raise
+    logger.info(f"Ingested {len(prices)} prices, {len(created)} new listings, {len(candidates)} candidates")
+    return len(prices)
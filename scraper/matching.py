@@ -0,0 +1,242 @@
+import logging
+import os
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import text
+
+logger = logging.getLogger("matching")
+
+# How many query vectors are resolved per round trip to Postgres
+MATCH_BATCH_SIZE = int(os.getenv("MATCH_BATCH_SIZE", "500"))
+# Cosine distance below which two titles are considered the same product
+MATCH_DISTANCE_THRESHOLD = float(os.getenv("MATCH_DISTANCE_THRESHOLD", "0.15"))
+
+# "full" searches the float32 embeddings. "halfvec" and "binary" search the
+# quantized expression indexes and re-rank their top candidates in full precision.
+MATCH_PRECISION = os.getenv("MATCH_PRECISION", "full")
+# Candidates fetched from a quantized index before the full precision re-rank
+MATCH_RERANK_CANDIDATES = int(os.getenv("MATCH_RERANK_CANDIDATES", "40"))
+# hnsw.ef_search used by nearest product lookups (0 keeps the server setting, 40 by default)
+MATCH_EF_SEARCH = int(os.getenv("MATCH_EF_SEARCH", "0"))
+# Single vector lookups run as server-side prepared statements (disable behind transaction-mode PgBouncer)
+MATCH_PREPARED_STATEMENTS = os.getenv("MATCH_PREPARED_STATEMENTS", "true").lower() == "true"
+EMBEDDING_DIM = 384
+
+# One LATERAL nearest-neighbour lookup per input vector, in a single statement.
+# The ORDER BY expression matches the per-row query so the HNSW index is used.
+NEAREST_PRODUCTS_QUERY = text("""
+    SELECT
+        q.ord,
+        nearest.product_id,
+        nearest.distance
+    FROM
+        unnest(CAST(:vectors AS text[])) WITH ORDINALITY AS q(vec, ord)
+    LEFT JOIN LATERAL (
+        SELECT
+            pe.product_id,
+            pe.embedding <=> q.vec::vector AS distance
+        FROM
+            product_embeddings pe
+        ORDER BY
+            pe.embedding <=> q.vec::vector
+        LIMIT 1
+    ) nearest ON TRUE
+    ORDER BY q.ord
+""")
+
+# ORDER BY expressions matching the expression indexes of the
+# quantized_embedding_indexes migration
+QUANTIZED_ORDER = {
+    "halfvec": f"pe.embedding::halfvec({EMBEDDING_DIM}) <=> {{vec}}::halfvec({EMBEDDING_DIM})",
+    "binary": f"binary_quantize(pe.embedding)::bit({EMBEDDING_DIM}) <~> binary_quantize({{vec}}::vector)",
+}
+
+RERANKED_NEAREST_PRODUCTS_QUERY = """
+    SELECT
+        q.ord,
+        nearest.product_id,
+        nearest.distance
+    FROM
+        unnest(CAST(:vectors AS text[])) WITH ORDINALITY AS q(vec, ord)
+    LEFT JOIN LATERAL (
+        SELECT
+            candidates.product_id,
+            candidates.embedding <=> q.vec::vector AS distance
+        FROM (
+            SELECT pe.product_id, pe.embedding
+            FROM product_embeddings pe
+            ORDER BY {order}
+            LIMIT :candidates
+        ) candidates
+        ORDER BY distance
+        LIMIT 1
+    ) nearest ON TRUE
+    ORDER BY q.ord
+"""
+
+NEAREST_PRODUCTS_QUERIES = {
+    "full": NEAREST_PRODUCTS_QUERY,
+    **{
+        precision: text(RERANKED_NEAREST_PRODUCTS_QUERY.format(order=order.format(vec="q.vec")))
+        for precision, order in QUANTIZED_ORDER.items()
+    },
+}
+
+# Top-k lookup of a single vector, prepared once per connection.
+# $1 is the query vector, $2 k and $3 the re-rank candidates of quantized searches.
+PREPARED_NEAREST_SQL = {
+    "full": """
+        SELECT pe.product_id, pe.embedding <=> $1 AS distance
+        FROM product_embeddings pe
+        ORDER BY pe.embedding <=> $1
+        LIMIT $2
+    """,
+    **{
+        precision: f"""
+            SELECT candidates.product_id, candidates.distance
+            FROM (
+                SELECT pe.product_id, pe.embedding <=> $1 AS distance
+                FROM product_embeddings pe
+                ORDER BY {order.format(vec="$1")}
+                LIMIT $3
+            ) candidates
+            ORDER BY candidates.distance
+            LIMIT $2
+        """
+        for precision, order in QUANTIZED_ORDER.items()
+    },
+}
+
+SET_EF_SEARCH = text("SELECT set_config('hnsw.ef_search', :ef_search, true)")
+
+
+class NearestProduct(NamedTuple):
+    product_id: int
+    distance: float
+
+
+def vector_literal(vector) -> str:
+    """
+    Format a vector as a pgvector text literal ('[x,y,...]'). pgvector stores
+    float32, and 9 significant digits round-trip it exactly without the float64 noise of str().
+    """
+    return "[" + ",".join(["%.9g" % v for v in np.asarray(vector, dtype=np.float32).tolist()]) + "]"
+
+
+def find_nearest_products(session, vectors, batch_size: int = MATCH_BATCH_SIZE,
+                          precision: str = MATCH_PRECISION, candidates: int = MATCH_RERANK_CANDIDATES) -> list:
+    """
+    Resolve the nearest product for every vector using set-based queries.
+    Returns a list aligned with `vectors` holding rows with `product_id` and
+    `distance`, or None where the catalogue is empty. Distances are always
+    computed on the full precision embeddings.
+    """
+    if precision not in NEAREST_PRODUCTS_QUERIES:
+        raise ValueError(f"Unknown match precision '{precision}', expected one of {list(NEAREST_PRODUCTS_QUERIES)}")
+    query = NEAREST_PRODUCTS_QUERIES[precision]
+    set_ef_search(session, MATCH_EF_SEARCH, candidates if precision != "full" else 0)
+    results = []
+    vectors = list(vectors)
+    for start in range(0, len(vectors), batch_size):
+        chunk = [vector_literal(v) for v in vectors[start:start + batch_size]]
+        params = {"vectors": chunk}
+        if precision != "full":
+            params["candidates"] = candidates
+        rows = session.execute(query, params).fetchall()
+        results.extend(row if row.product_id is not None else None for row in rows)
+    logger.info(f"Matched {len(results)} titles in {-(-len(vectors) // batch_size)} queries")
+    return results
+
+
+def cluster_vectors(vectors, threshold: float = MATCH_DISTANCE_THRESHOLD) -> np.ndarray:
+    """
+    Greedy leader clustering of a batch by cosine distance. Returns, for every
+    vector, the index of its cluster leader (the first vector of the cluster).
+    Each vector joins the first earlier leader within `threshold`.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    leaders = np.full(len(matrix), -1, dtype=np.int64)
+    if len(matrix) == 0:
+        return leaders
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1, norms)
+    # Batches are a few hundred rows, the full similarity matrix is cheap
+    close = (matrix @ matrix.T) > 1 - threshold
+    for i in range(len(matrix)):
+        if leaders[i] != -1:
+            continue
+        members = close[i] & (leaders == -1)
+        leaders[members] = i
+        leaders[i] = i
+    return leaders
+
+
+def find_nearest_clustered(session, vectors, threshold: float = MATCH_DISTANCE_THRESHOLD,
+                           batch_size: int = MATCH_BATCH_SIZE, index=None):
+    """
+    Clusters near-identical vectors of the batch and resolves only one nearest
+    product per cluster. Returns (nearest, leaders): `nearest` is aligned with
+    `vectors` like find_nearest_products (members share their leader's match)
+    and `leaders` is the output of cluster_vectors. With an in-memory `index`
+    (ann_index.ProductIndex) only its misses are looked up in Postgres.
+    """
+    leaders = cluster_vectors(vectors, threshold)
+    unique = np.unique(leaders)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if index is not None:
+        found = index.match(session, vectors[unique], threshold, batch_size)
+    else:
+        found = find_nearest_products(session, vectors[unique], batch_size)
+    nearest = dict(zip(unique.tolist(), found))
+    logger.info(f"Clustered {len(leaders)} titles into {len(unique)} groups")
+    return [nearest[leader] for leader in leaders.tolist()], leaders
+
+
+def set_ef_search(session, ef_search: int, needed: int = 0):
+    """
+    SET LOCAL hnsw.ef_search for the rest of the current transaction. It is
+    raised to `needed` (rows the index scan has to return) when the configured
+    value or the server default of 40 would cut the result short.
+    """
+    if needed > max(ef_search, 40):
+        ef_search = needed
+    if ef_search:
+        session.execute(SET_EF_SEARCH, {"ef_search": str(ef_search)})
+
+
+def prepare_nearest(session, precision: str) -> str:
+    """
+    PREPAREs the top-k statement on the session's connection the first time it
+    is used there. Returns the statement name.
+    """
+    name = f"nearest_products_{precision}"
+    connection = session.connection()
+    # Cleared by SQLAlchemy when the DBAPI connection is replaced
+    prepared = connection.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        connection.exec_driver_sql(f"PREPARE {name} (vector, int, int) AS {PREPARED_NEAREST_SQL[precision]}")
+        prepared.add(name)
+    return name
+
+
+def nearest_products(session, vector, k: int = 1, ef_search: int = MATCH_EF_SEARCH,
+                     precision: str = MATCH_PRECISION, candidates: int = MATCH_RERANK_CANDIDATES) -> list:
+    """
+    Top-k nearest products of one vector as NearestProduct(product_id, distance),
+    closest first. The vector is a bound pgvector parameter and the statement is
+    planned once per connection. `ef_search` tunes hnsw.ef_search for this call's
+    transaction.
+    """
+    if precision not in PREPARED_NEAREST_SQL:
+        raise ValueError(f"Unknown match precision '{precision}', expected one of {list(PREPARED_NEAREST_SQL)}")
+    candidates = max(candidates, k)
+    set_ef_search(session, ef_search, candidates if precision != "full" else k)
+    params = {"vector": vector_literal(vector), "k": k, "candidates": candidates}
+    if MATCH_PREPARED_STATEMENTS:
+        name = prepare_nearest(session, precision)
+        query = text(f"EXECUTE {name} (CAST(:vector AS vector), :k, :candidates)")
+    else:
+        sql = PREPARED_NEAREST_SQL[precision].replace("$1", "CAST(:vector AS vector)").replace("$2", ":k").replace("$3", ":candidates")
+        query = text(sql)
+    return [NearestProduct(row.product_id, row.distance) for row in session.execute(query, params)]
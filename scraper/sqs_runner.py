@@ -3,13 +3,23 @@ import boto3
 import json
 import os
 import pandas as pd
+from contextlib import aclosing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
 from sqlalchemy import create_engine, text
 import logging
 from sqlalchemy.orm import sessionmaker
 from database import Database
-from models import Listings, Prices, ProductCandidates, ProductEmbeddings, Products
-from base.mercadolibre import MercadoLibre  # Replace with actual import
+from models import ProductEmbeddings, Products, Queries
+from ingest import INGEST_MODE, ingest, mark_queries_scraped, safe_commit
+from matching import MATCH_DISTANCE_THRESHOLD, find_nearest_clustered
+from embedding_cache import EmbeddingCache
+from ann_index import load_product_index
+from consumer import SQSConsumer
+from base.mercadolibre import PAGE_FINGERPRINTS, MercadoLibre  # Replace with actual import
+from base.page_cache import PageCache
+from base.ratelimit import RateLimiter
+from base.connections import ConnectionManager
 from botocore.config import Config
 
 logging.basicConfig(level=logging.INFO)
@@ -22,156 +32,224 @@ sqs = boto3.client(
 )
 database = Database()
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")  # or hardcode it here
+# Listings per embedding/DB batch and pages fetched concurrently per message
+SCRAPE_BATCH_SIZE = int(os.getenv("SCRAPE_BATCH_SIZE", "500"))
+MAX_PAGES_IN_FLIGHT = int(os.getenv("MAX_PAGES_IN_FLIGHT", "20"))
+# Worker processes parsing HTML off the event loop, shared by every message (0 parses inline)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))
+parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS) if PARSE_WORKERS > 0 else None
+# Page fingerprint cache kept across messages: unchanged pages skip parsing and DB work (0 disables)
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "0"))
+PAGE_CACHE_MAX_AGE = float(os.getenv("PAGE_CACHE_MAX_AGE", "0")) or None
+page_cache = PageCache(max_entries=PAGE_CACHE_MAX_ENTRIES, max_age=PAGE_CACHE_MAX_AGE) if PAGE_CACHE_MAX_ENTRIES > 0 else None
+# Request budget and pooled connections shared by every message: concurrent messages
+# scraping the same host stay within one rate limit and reuse the same keep-alive connections
+REQUESTS_PER_MINUTE = int(os.getenv("REQUESTS_PER_MINUTE", "1000"))
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, jitter=(0, 1))
+connections = ConnectionManager()
+# Read the result count from page 1 and only fetch the pages that exist
+ADAPTIVE_PAGINATION = os.getenv("ADAPTIVE_PAGINATION", "true").lower() == "true"
+# Messages scraped concurrently and how long each stays invisible between heartbeats
+SQS_MAX_WORKERS = int(os.getenv("SQS_MAX_WORKERS", "4"))
+SQS_VISIBILITY_TIMEOUT = int(os.getenv("SQS_VISIBILITY_TIMEOUT", "300"))
+# Batches buffered between the scrape, embed and load stages of a message
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+# Threads running model.encode and the synchronous SQLAlchemy work off the event loop
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+DB_WORKERS = int(os.getenv("DB_WORKERS", "2"))
+embed_pool = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+db_pool = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
 
 # Initialize SentenceTransformer model once globally (avoid reloading each time)
 model = SentenceTransformer('all-MiniLM-L6-v2')
+# Shared by the embed and load stages: each title is encoded once, across messages too
+embedding_cache = EmbeddingCache(model)
+# In-memory nearest product index (ANN_INDEX), loaded when polling starts
+product_index = None
 
 async def handle_message(message_body):
-    """Parse SQS message and run MercadoLibre scraper, vectorize 'title' column"""
+    """
+    Parse SQS message and run the scrape -> embed -> load pipeline for its queries.
+    The stages run concurrently, joined by bounded queues, so pages keep being
+    fetched while earlier batches are encoded and written to the database.
+    A query value is a page count or a [first_page, end_page) shard of a deep query.
+    """
     try:
         data = json.loads(message_body)
         queries = data.get("queries", {})
-        scraper = MercadoLibre(queries=queries)
-
-        df = await scraper.perform_scrape()
-
-        # Check if 'title' column exists
-        if "title" in df.columns:
-            titles = df["title"].astype(str).tolist()  # Ensure all titles are strings
-            embeddings = model.encode(titles, show_progress_bar=False)
-
-            # Add embeddings as a new column (list of floats)
-            df["title_vector"] = list(embeddings)
-        else:
-            print("Warning: 'title' column not found in scraped DataFrame.")
-
-        await load_to_db(df)
+        # Other workers load the remaining shards of the query at the same time, the
+        # bulk path's ON CONFLICT upserts merge listings they both found
+        ingest_mode = "bulk" if any(isinstance(pages, list) for pages in queries.values()) else INGEST_MODE
+        to_embed = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        to_load = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        async with MercadoLibre(
+            queries=queries,
+            executor=parse_pool,
+            page_cache=page_cache,
+            adaptive_pagination=ADAPTIVE_PAGINATION,
+            rate_limiter=rate_limiter,
+            connections=connections
+        ) as scraper:
+            # If a stage fails the TaskGroup cancels the other two
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(scrape_stage(scraper, to_embed))
+                stages.create_task(embed_stage(to_embed, to_load))
+                stages.create_task(load_stage(to_load, ingest_mode))
+        await asyncio.get_running_loop().run_in_executor(db_pool, mark_scraped, list(queries))
+        logger.info(f"Embedding cache stats: {embedding_cache.cache_stats()}")
+        if product_index is not None:
+            logger.info(f"ANN index stats: {product_index.index_stats()}")
 
     except Exception as e:
-        print(f"Error handling message: {e}")
-
-
-async def load_to_db(df:pd.DataFrame):
-    all_new_products = []
-    all_products = []
-    all_product_embeddings = []
-    new_candidates = []
-    new_listings = []
-    all_listings = {}
-    safe_commit_flag = False
-    query_list = []
-    query_text:str
-    for query_text in df["query"]:
-        query_list.extend(query_text.split("-QUERYSEP-"))
-    queries_objs = database.retrieve_queries(queries=query_list)
-    queries_map = {q.query_text: q for q in queries_objs}
-
-    for product in df.itertuples(index=False):
-        nearest_product = database.find_nearest_title(product)
-        if nearest_product and nearest_product.distance < 0.15:
-            nearest_product = database.session.query(Products).filter(Products.id == nearest_product.product_id).first()
-        else:
-            nearest_product = Products(
-                name = product.title,
-            )
-            all_new_products.append(nearest_product)
-        all_products.append(nearest_product)
+        errors = e.exceptions if isinstance(e, ExceptionGroup) else [e]
+        logger.error(f"Error handling message: {'; '.join(map(repr, errors))}")
+        # Not acknowledged: the message is redelivered after its visibility timeout
+        raise
+
+
+async def scrape_stage(scraper:MercadoLibre, out:asyncio.Queue):
+    async with aclosing(scraper.iter_batches(batch_size=SCRAPE_BATCH_SIZE, max_in_flight=MAX_PAGES_IN_FLIGHT)) as batches:
+        async for df in batches:
+            await out.put(df)
+    await out.put(None)
+
+
+async def embed_stage(inbox:asyncio.Queue, out:asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while (df := await inbox.get()) is not None:
+        titles = df["title"].astype(str).tolist()  # Ensure all titles are strings
+        embeddings = await loop.run_in_executor(embed_pool, encode_titles, titles)
+
+        # Add embeddings as a new column (list of floats)
+        df["title_vector"] = list(embeddings)
+        await out.put(df)
+    await out.put(None)
+
+
+async def load_stage(inbox:asyncio.Queue, ingest_mode:str = INGEST_MODE):
+    loop = asyncio.get_running_loop()
+    while (df := await inbox.get()) is not None:
+        await loop.run_in_executor(db_pool, load_to_db, df, ingest_mode)
+        # Only now the batch is committed: its pages can be skipped next time
+        if page_cache is not None:
+            page_cache.save(df.attrs.get(PAGE_FINGERPRINTS, {}))
+
+
+def encode_titles(titles:list):
+    return embedding_cache.encode(titles)
+
+
+def mark_scraped(query_texts:list):
+    with database.Session() as session:
+        mark_queries_scraped(session, query_texts)
+
+
+def load_to_db(df:pd.DataFrame, ingest_mode:str = INGEST_MODE):
+    """
+    Matches a batch against existing products and ingests it. Runs in the DB
+    thread pool with its own session.
+    """
+    with database.Session() as session:
+        all_new_products = []
+        new_product_vectors = []
+        all_products = []
+        all_product_embeddings = []
+        query_list = []
+        query_text:str
+        for query_text in df["query"]:
+            query_list.extend(query_text.split("-QUERYSEP-"))
+        queries_objs = session.query(Queries).filter(Queries.query_text.in_(query_list)).all()
+        queries_map = {q.query_text: q for q in queries_objs}
+
+        vectors = list(df["title_vector"])
+        # Near-identical titles of the batch share one lookup and at most one new product
+        nearest_products, clusters = find_nearest_clustered(session, vectors, index=product_index)
+        matched_ids = {n.product_id for n in nearest_products if n and n.distance < MATCH_DISTANCE_THRESHOLD}
+        matched_products = {
+            p.id: p for p in session.query(Products).filter(Products.id.in_(matched_ids)).all()
+        } if matched_ids else {}
+        # A match whose product is gone (deleted after the index was loaded) counts as
+        # no match: the listing gets a new product instead of failing the batch
+        missing = matched_ids - matched_products.keys()
+        if missing:
+            logger.warning(f"⚠️ Matched products no longer exist: {sorted(missing)}")
+            nearest_products = [n if n is None or n.product_id not in missing else None for n in nearest_products]
+
+        new_by_cluster = {}
+        for product, cluster, nearest_product in zip(df.itertuples(index=False), clusters, nearest_products):
+            if nearest_product and nearest_product.distance < MATCH_DISTANCE_THRESHOLD:
+                nearest_product = matched_products[nearest_product.product_id]
+            elif cluster in new_by_cluster:
+                nearest_product = new_by_cluster[cluster]
+            else:
+                nearest_product = Products(
+                    name = product.title,
+                )
+                new_by_cluster[cluster] = nearest_product
+                all_new_products.append(nearest_product)
+                new_product_vectors.append(product.title_vector)
+            all_products.append(nearest_product)
+                    
                 
-            
-    if len(all_new_products) != 0:
-        database.session.add_all(all_new_products)
-        database.safe_commit() 
-    for product in all_new_products:
-        emb = ProductEmbeddings(
-            product_id = product.id,
-            embedding = list(map(float,database.model.encode(product.name, normalize_embeddings=True)))
-        )
-        all_product_embeddings.append(emb)
-    if len(all_product_embeddings) != 0:
-        database.session.add_all(all_product_embeddings)
-        database.safe_commit()
-
-    for i, prod in enumerate(df.itertuples(index=False)):
-        listing = database.find_listing_by_ml_id(prod)
-        if not listing:
-            try:
-                distance = all_products[i].distance
-            except Exception:
-                distance = 0.0
-            listing = Listings(
-                external_id=prod.ml_id,
-                title=prod.title,
-                url=prod.url,
-                marketplace_id=1,
-                img_url=prod.img_url
+        if len(all_new_products) != 0:
+            session.add_all(all_new_products)
+            safe_commit(session)
+        # The title vector computed by the embed stage doubles as the product embedding
+        for product, vector in zip(all_new_products, new_product_vectors):
+            emb = ProductEmbeddings(
+                product_id = product.id,
+                embedding = list(map(float, vector))
             )
-            new_listings.append(listing)
-
-            for query_text in prod.query.split("-QUERYSEP-"):
-                if query_text not in queries_map:
-                    continue
-                query_obj = queries_map[query_text]
-                candidate = ProductCandidates(
-                    query_id=query_obj.id,
-                    product_id=all_products[i].id,
-                    match_method='cosine',
-                    distance=distance,
-                    decided=False,
-                    listing=listing
-                )
-                new_candidates.append(candidate)
-        elif listing.img_url != prod.img_url:
-            listing.img_url = prod.img_url
-            safe_commit_flag = True
-        all_listings[prod] = listing
-    if new_listings:
-        database.session.add_all(new_listings)
-        safe_commit_flag = True
-    if safe_commit_flag:
-        database.safe_commit()
-
-    for candidate in new_candidates:
-        candidate.listing_id = candidate.listing.id
-    if new_candidates:
-        database.session.add_all(new_candidates)
-        database.safe_commit()
-
-    all_prices = []
-    for prod, listing in all_listings.items():
-        price = Prices(
-            listing_id=listing.id,
-            price=float(prod.price)
+            all_product_embeddings.append(emb)
+        if len(all_product_embeddings) != 0:
+            session.add_all(all_product_embeddings)
+            safe_commit(session)
+            if product_index is not None:
+                product_index.add([product.id for product in all_new_products], new_product_vectors)
+
+        distances = [
+            n.distance if n and n.distance < MATCH_DISTANCE_THRESHOLD else 0.0
+            for n in nearest_products
+        ]
+        ingest(
+            session,
+            df,
+            [product.id for product in all_products],
+            distances,
+            queries_map,
+            mode=ingest_mode
         )
-        all_prices.append(price)
-    database.session.add_all(all_prices)
-    database.safe_commit()
-    
 
-async def poll_sqs():
-    while True:
-        try:
-            response = sqs.receive_message(
-                QueueUrl=SQS_QUEUE_URL,
-                MaxNumberOfMessages=1,
-                WaitTimeSeconds=20  # Long polling
-            )
-        except Exception as e:
-            logger.error(f"Error polling SQS: {e}")
-            await asyncio.sleep(5)  # Wait before retrying
-            continue
-
-        messages = response.get("Messages", [])
-        if not messages:
-            continue
-
-        for msg in messages:
-            receipt_handle = msg["ReceiptHandle"]
-            body = msg["Body"]
 
-            await handle_message(body)
-
-            # Delete message from queue after processing
-            sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
+async def poll_sqs():
+    global product_index
+    with database.Session() as session:
+        product_index = await asyncio.to_thread(load_product_index, session)
+    consumer = SQSConsumer(
+        sqs,
+        SQS_QUEUE_URL,
+        handle_message,
+        max_workers=SQS_MAX_WORKERS,
+        visibility_timeout=SQS_VISIBILITY_TIMEOUT,
+        heartbeat_interval=SQS_VISIBILITY_TIMEOUT / 3
+    )
+    try:
+        await consumer.run()
+    finally:
+        await connections.close()
+
+def shutdown_pools():
+    """
+    Waits for the shared worker pools to finish and exit, so no parse
+    processes are left behind when the runner stops.
+    """
+    if parse_pool is not None:
+        parse_pool.shutdown(wait=True, cancel_futures=True)
+    embed_pool.shutdown(wait=True, cancel_futures=True)
+    db_pool.shutdown(wait=True, cancel_futures=True)
 
 if __name__ == "__main__":
-    asyncio.run(poll_sqs())
+    try:
+        asyncio.run(poll_sqs())
+    finally:
+        shutdown_pools()
@@ -363,7 +363,7 @@ resource "aws_ecs_service" "scraper" {
   name            = "mercado-scraper-service"
   cluster         = aws_ecs_cluster.mercado_cluster.id
   task_definition = aws_ecs_task_definition.scraper_task.arn
-  desired_count   = 1
+  desired_count   = var.scraper_desired_count
   launch_type     = "FARGATE"
 
   network_configuration {
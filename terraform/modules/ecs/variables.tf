@@ -52,4 +52,10 @@ variable "frontend_image" {
 variable "scraper_image" {
   description = "Scraper Docker image URI with immutable tag"
   type        = string
-} 
\ No newline at end of file
+} 
+
+variable "scraper_desired_count" {
+  description = "Scraper tasks consuming the SQS queue (shards of deep queries are spread across them)"
+  type        = number
+  default     = 1
+}
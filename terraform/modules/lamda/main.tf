@@ -1,8 +1,9 @@
-# Create a CloudWatch EventBridge rule that runs every day at midnight UTC
+# Create a CloudWatch EventBridge rule that runs every hour; the lambda only
+# sends the queries whose frequency (hourly/daily/weekly/monthly) is due
 resource "aws_cloudwatch_event_rule" "daily_schedule" {
   name                = "daily-scraper-trigger"
-  description         = "Trigger the scraper lambda every day"
-  schedule_expression = "cron(0 0 * * ? *)"
+  description         = "Trigger the scraper lambda every hour"
+  schedule_expression = "cron(0 * * * ? *)"
 }
 
 # Set the EventBridge rule to trigger your Lambda function
@@ -1,11 +1,31 @@
 data "aws_iam_role" "lab_role" {
   name = "LabRole"
 }
+# Messages that keep failing end up here instead of being retried forever
+resource "aws_sqs_queue" "scraper_dlq" {
+  name                      = "mercado-scraper-dlq.fifo"
+  message_retention_seconds = 1209600 # 14 days, time to inspect and redrive them
+  fifo_queue                = true
+}
+
 resource "aws_sqs_queue" "scraper_queue" {
   name                      = "mercado-scraper-queue.fifo"
   visibility_timeout_seconds = 300  # Time a message stays "invisible" after being received
   message_retention_seconds = 86400 # 1 day
   fifo_queue                = true 
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.scraper_dlq.arn
+    maxReceiveCount     = 5 # Deliveries before a message is moved to the DLQ
+  })
+}
+
+resource "aws_sqs_queue_redrive_allow_policy" "scraper_dlq" {
+  queue_url = aws_sqs_queue.scraper_dlq.id
+
+  redrive_allow_policy = jsonencode({
+    redrivePermission = "byQueue",
+    sourceQueueArns   = [aws_sqs_queue.scraper_queue.arn]
+  })
 }
 
 resource "aws_iam_policy" "ecs_sqs_access" {
@@ -21,6 +41,7 @@ resource "aws_iam_policy" "ecs_sqs_access" {
           "sqs:SendMessage",
           "sqs:ReceiveMessage",
           "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
           "sqs:GetQueueAttributes"
         ],
         Resource = aws_sqs_queue.scraper_queue.arn
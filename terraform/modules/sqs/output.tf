@@ -2,3 +2,8 @@ output "scraper_sqs_queue_url" {
   description = "URL of the Mercado scraper SQS queue"
   value       = aws_sqs_queue.scraper_queue.id
 }
+
+output "scraper_dlq_url" {
+  description = "URL of the dead-letter queue of the Mercado scraper queue"
+  value       = aws_sqs_queue.scraper_dlq.id
+}